@@ -1,19 +1,32 @@
 import ollama
-from shiny import App, Inputs, Outputs, Session, render, ui
+from shiny import App, Inputs, Outputs, Session, reactive, render, req, ui
 
 from shared import views
-from shared.defns import MessageFormat
-from shared.utils import stream_response
+from shared.defns import (
+    CHAT_DISPLAY_MAX_MESSAGES,
+    CHAT_DISPLAY_PAGE_SIZE,
+    CHAT_HISTORY_MAX_TOKENS,
+    CHAT_SESSION_LIST_SIZE,
+    OLLAMA_KEEP_ALIVE,
+    OLLAMA_NUM_CTX,
+)
+from shared.sessions import SessionStore, to_ollama_messages
+from shared.utils import record_stream, stream_response
+
+APP_NAME = "chatapp"
 
 side_bar = ui.sidebar(
+    ui.output_ui("session_handler"),
     views.create_llm_select(),
     views.create_temp_slider(),
+    views.create_prompt_layout_switch(),
     ui.input_dark_mode(mode="dark"),
     width=300,
     id="sidebar",
 )
 app_ui = ui.page_sidebar(
     side_bar,
+    views.create_client_id_script(),
     ui.output_ui(id="title_handler"),
     ui.chat_ui(
         id="chat",
@@ -27,6 +40,25 @@ app_ui = ui.page_sidebar(
 
 def server(input: Inputs, output: Outputs, session: Session):
     chat = ui.Chat(id="chat", on_error="sanitize")
+    session_store = SessionStore()
+
+    current_session = reactive.Value(None)
+    display_size = reactive.Value(CHAT_DISPLAY_PAGE_SIZE)
+
+    @reactive.calc
+    def client_id() -> str:
+        # sent by the client id script once the browser has connected
+        return req(input.client_id())
+
+    @render.ui
+    def session_handler():
+        # re-rendered when this tab starts or switches session, so a new chat is listed
+        sessions = session_store.list_sessions(
+            app=APP_NAME, client_id=client_id(), limit=CHAT_SESSION_LIST_SIZE
+        )
+        return views.create_session_select(
+            choices={s.id: s.title for s in sessions}, selected=current_session()
+        )
 
     @render.ui
     def title_handler():
@@ -36,6 +68,39 @@ def server(input: Inputs, output: Outputs, session: Session):
             ),
         )
 
+    async def trim_display(session_id: str):
+        # the ui transcript would otherwise grow for as long as the session runs
+        if len(chat.messages()) > CHAT_DISPLAY_MAX_MESSAGES:
+            display_size.set(CHAT_DISPLAY_PAGE_SIZE)
+            await show_session(session_id)
+
+    async def show_session(session_id: str | None):
+        # only the most recent page of a resumed session is loaded into the ui
+        await chat.clear_messages()
+        if session_id is not None:
+            for msg in session_store.load_recent(
+                session_id, client_id(), limit=display_size()
+            ):
+                await chat.append_message({"role": msg.role, "content": msg.content})
+
+    @reactive.effect
+    @reactive.event(input.chat_session)
+    async def _():
+        session_id = input.chat_session() or None
+        if session_id == current_session():
+            return
+
+        current_session.set(session_id)
+        display_size.set(CHAT_DISPLAY_PAGE_SIZE)
+        await show_session(session_id)
+
+    @reactive.effect
+    @reactive.event(input.load_older)
+    async def _():
+        if current_session() is not None:
+            display_size.set(display_size() + CHAT_DISPLAY_PAGE_SIZE)
+            await show_session(current_session())
+
     @chat.on_user_submit
     def _():
         ui.update_sidebar(id="sidebar", show=False)
@@ -43,19 +108,46 @@ def server(input: Inputs, output: Outputs, session: Session):
 
     @chat.on_user_submit
     async def _():
-        # TODO: note that the messages keep track of all messages: both question and response;
-        # this might be an issue of memory and context: find a way of truncating messages down to
-        # top n chat history or use token_limits below
-        messages = chat.messages(format=MessageFormat.OLLAMA, token_limits=None)
+        query = chat.user_input()
+        # read here, as the stream's completion callback runs outside the reactive context
+        client = client_id()
+
+        session_id = current_session()
+        if session_id is None:
+            session_id = session_store.create_session(
+                app=APP_NAME, client_id=client, title=query[:50]
+            )
+            current_session.set(session_id)
+
+        session_store.append_message(session_id, client, role="user", content=query)
+        await trim_display(session_id)
+
+        # history comes from the store, bounded by tokens, rather than the full ui transcript
+        load_history = (
+            session_store.load_stable_window
+            if input.stable_prefix()
+            else session_store.load_window
+        )
+        messages = to_ollama_messages(
+            load_history(session_id, client, max_tokens=CHAT_HISTORY_MAX_TOKENS)
+        )
 
         response = ollama.chat(
             model=input.model(),
             messages=messages,
             stream=True,
-            options={"temperature": input.llm_temp()},
+            keep_alive=OLLAMA_KEEP_ALIVE,
+            options={"temperature": input.llm_temp(), "num_ctx": OLLAMA_NUM_CTX},
         )
 
-        await chat.append_message_stream(stream_response(response))
+        await chat.append_message_stream(
+            record_stream(
+                stream_response(response),
+                on_complete=lambda answer: session_store.append_message(
+                    session_id, client, role="assistant", content=answer
+                ),
+            )
+        )
 
 
 app = App(app_ui, server)
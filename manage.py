@@ -0,0 +1,68 @@
+import argparse
+import sys
+
+from shared.defns import MATRYOSHKA_DIMS, EmbeddingPrecision
+from shared.utils import CollectionClient
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Manage chatty document collections")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    reindex = commands.add_parser(
+        "reindex",
+        help="Rewrite a collection with a different stored embedding size and precision",
+    )
+    reindex.add_argument("collection")
+    reindex.add_argument("--dim", type=int, choices=MATRYOSHKA_DIMS, required=True)
+    reindex.add_argument(
+        "--precision",
+        choices=list(EmbeddingPrecision),
+        default=EmbeddingPrecision.FLOAT32,
+    )
+
+    export = commands.add_parser(
+        "export", help="Write a collection, vectors included, to a snapshot bundle"
+    )
+    export.add_argument("collection")
+    export.add_argument("path")
+
+    import_ = commands.add_parser(
+        "import",
+        help="Restore a collection from a snapshot bundle without re-embedding",
+    )
+    import_.add_argument("path")
+    import_.add_argument(
+        "--name", help="Name of the restored collection; defaults to the exported name"
+    )
+
+    args = parser.parse_args()
+    client = CollectionClient()
+
+    match args.command:
+        case "reindex":
+            err = client.reindex_collection(
+                name=args.collection,
+                embedding_dim=args.dim,
+                embedding_precision=EmbeddingPrecision(args.precision),
+            )
+            message = (
+                f"Re-indexed {args.collection} to {args.dim} dims, {args.precision}"
+            )
+
+        case "export":
+            err = client.export_collection(name=args.collection, path=args.path)
+            message = f"Exported {args.collection} to {args.path}"
+
+        case "import":
+            err = client.import_collection(path=args.path, name=args.name)
+            message = f"Imported {args.path}"
+
+    if err is not None:
+        sys.exit(err)
+
+    print(message)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,24 +1,52 @@
 import time
 
-from shiny import App, Inputs, Outputs, Session, reactive, render, ui
+from shiny import App, Inputs, Outputs, Session, reactive, render, req, ui
 from shiny.types import FileInfo
 
 from shared import views
-from shared.defns import NOTIFICATION_DURATION, FileType, MessageFormat
+from shared.defns import (
+    CHANGE_POLL_INTERVAL,
+    CHAT_DISPLAY_MAX_MESSAGES,
+    CHAT_DISPLAY_PAGE_SIZE,
+    CHAT_HISTORY_MAX_TOKENS,
+    CHAT_SESSION_LIST_SIZE,
+    NOTIFICATION_DURATION,
+    DocSplitterDefaultArgs,
+    EmbeddingPrecision,
+    FileType,
+    PromptLayout,
+    SplitterUnit,
+    TokenSplitterDefaultArgs,
+)
 from shared.rag import (
     create_chain,
     create_retrieval,
+    load_csv_blocks,
     load_docs,
     split_docs,
+    split_docs_into_parents,
     validate_splitter_args,
 )
-from shared.utils import CollectionClient, CollectionDescription, stream_response
+from shared.sessions import SessionStore, to_langchain_messages
+from shared.utils import (
+    CollectionClient,
+    CollectionDescription,
+    arecord_stream,
+    astream_response,
+    file_sha256,
+)
+
+APP_NAME = "ragapp"
 
 side_bar = ui.sidebar(
     views.create_help_pannel(),
+    ui.output_ui("session_handler"),
     views.create_llm_select(),
     ui.output_ui("collection_handler"),
+    ui.output_ui("document_handler"),
     views.create_temp_slider(),
+    views.create_speculative_switch(),
+    views.create_prompt_layout_switch(),
     views.create_desc_value_box(ui.output_ui("desc_text_handler")),
     ui.input_task_button(
         id="set_params",
@@ -32,6 +60,7 @@ side_bar = ui.sidebar(
 )
 app_ui = ui.page_sidebar(
     side_bar,
+    views.create_client_id_script(),
     ui.output_ui(id="title_handler"),
     ui.chat_ui(
         id="chat",
@@ -46,16 +75,68 @@ app_ui = ui.page_sidebar(
 def server(input: Inputs, output: Outputs, session: Session):
     chat = ui.Chat(id="chat", on_error="sanitize")
     client_obj = CollectionClient()
+    session_store = SessionStore()
+
+    current_session = reactive.Value(None)
+    display_size = reactive.Value(CHAT_DISPLAY_PAGE_SIZE)
+
+    @reactive.calc
+    def client_id() -> str:
+        # sent by the client id script once the browser has connected
+        return req(input.client_id())
 
     chain = reactive.Value()
+    # the chain's prompt layout decides how chat history is windowed on submit
+    prompt_layout = reactive.Value(PromptLayout.DEFAULT)
 
     collection_list = reactive.Value(client_obj.list_collections())
 
     collection_desc = reactive.Value(CollectionDescription)
 
+    document_list = reactive.Value([])
+
+    @reactive.calc
+    def active_collection() -> str | None:
+        # several collections can be selected as chat context; the first one is the one
+        # described and managed from the action centre
+        selected = input.collection()
+        return selected[0] if selected else None
+
+    @render.ui
+    def session_handler():
+        # re-rendered when this tab starts or switches session, so a new chat is listed
+        sessions = session_store.list_sessions(
+            app=APP_NAME, client_id=client_id(), limit=CHAT_SESSION_LIST_SIZE
+        )
+        return views.create_session_select(
+            choices={s.id: s.title for s in sessions}, selected=current_session()
+        )
+
     @render.ui
     def collection_handler():
-        return views.create_collection_select(choices=collection_list())
+        # rendered once; later changes go through update_select so the selection survives
+        with reactive.isolate():
+            return views.create_collection_select(choices=collection_list())
+
+    def refresh_collections():
+        # touch the select only when the set of collections changed, keeping what is selected
+        names = client_obj.list_collections()
+        with reactive.isolate():
+            if set(names) == set(collection_list()):
+                return
+
+            collection_list.set(names)
+            ui.update_select(
+                id="collection",
+                choices=names,
+                selected=[c for c in input.collection() if c in names] or names[:1],
+            )
+
+    @render.ui
+    def document_handler():
+        return views.create_document_select(
+            choices={doc.tag: doc.source or doc.tag for doc in document_list()}
+        )
 
     @render.ui
     def title_handler():
@@ -71,7 +152,7 @@ def server(input: Inputs, output: Outputs, session: Session):
 
     @render.ui
     def desc_text_handler():
-        if collection_list():
+        if active_collection():
             desc = collection_desc()
             return ui.markdown(f"""
                     # {desc.name}
@@ -79,8 +160,12 @@ def server(input: Inputs, output: Outputs, session: Session):
                     - **Date created**: {desc.date_created}
                     - **Tag**: {desc.tag}
                     - **Number of documents or chunks**: {desc.num_chunks}
+                    - **Stored embeddings**: {desc.embedding_dim} dims, {desc.embedding_precision}
                     """)
 
+        if collection_list():
+            return ui.markdown("No collection is selected. Please select one above.")
+
         return ui.markdown(
             "You don't have any collection yet. Please create one by clicking on the **Create collection** button below."
         )
@@ -88,25 +173,38 @@ def server(input: Inputs, output: Outputs, session: Session):
     @reactive.effect
     @reactive.event(input.goto_add_document)
     def _():
-        if collection_list():
-            ui.modal_show(views.create_doc_add_modal(input.collection()))
+        if active_collection():
+            ui.modal_show(views.create_doc_add_modal(active_collection()))
             ui.update_popover(id="collection_options_popover", show=False)
 
         else:
             views.no_selected_collection_message(duration=NOTIFICATION_DURATION)
 
+    @reactive.effect
+    @reactive.event(input.splitter_unit)
+    def _():
+        # token chunks are much shorter than character chunks; swap in sensible defaults
+        defaults = (
+            TokenSplitterDefaultArgs
+            if input.splitter_unit() == SplitterUnit.TOKEN
+            else DocSplitterDefaultArgs
+        )
+        ui.update_numeric("splitter_chunk_size", value=defaults.CHUNK_SIZE)
+        ui.update_numeric("splitter_chunk_overlap", value=defaults.CHUNK_OVERLAP)
+
     @reactive.effect
     @reactive.event(input.goto_delete_collection)
     def _():
-        if collection_list():
-            ui.modal_show(views.create_del_collection_modal(input.collection()))
+        if active_collection():
+            ui.modal_show(views.create_del_collection_modal(active_collection()))
         else:
             views.no_selected_collection_message(duration=NOTIFICATION_DURATION)
 
     @reactive.effect
     @reactive.event(input.delete_collection)
     def _():
-        err = client_obj.delete_collection(input.collection())
+        name = active_collection()
+        err = client_obj.delete_collection(name)
         time.sleep(2)
 
         if err is not None:
@@ -116,11 +214,57 @@ def server(input: Inputs, output: Outputs, session: Session):
                 duration=NOTIFICATION_DURATION,
             )
         else:
-            collection_list.set(client_obj.list_collections())
-            ui.update_select(id="collection", choices=collection_list())
+            refresh_collections()
 
             ui.notification_show(
-                f"{input.collection()} deleted successfully.",
+                f"{name} deleted successfully.",
+                type="message",
+                duration=NOTIFICATION_DURATION,
+            )
+
+            ui.modal_remove()
+
+    @reactive.effect
+    @reactive.event(input.goto_delete_document)
+    def _():
+        if not active_collection():
+            views.no_selected_collection_message(duration=NOTIFICATION_DURATION)
+        elif not input.documents():
+            ui.notification_show(
+                "No document is selected. Please select the document(s) to delete",
+                duration=NOTIFICATION_DURATION,
+                type="error",
+            )
+        else:
+            names = {doc.tag: doc.source or doc.tag for doc in document_list()}
+            ui.modal_show(
+                views.create_del_document_modal(
+                    active_collection(), [names[tag] for tag in input.documents()]
+                )
+            )
+
+    @reactive.effect
+    @reactive.event(input.delete_document)
+    def _():
+        errors = []
+        for tag in input.documents():
+            err = client_obj.delete_documents(active_collection(), tag)
+            if err is not None:
+                errors.append(err)
+
+        document_list.set(client_obj.list_documents(active_collection()))
+        desc, _ = client_obj.describe_collection(active_collection())
+        collection_desc.set(desc)
+
+        if errors:
+            ui.notification_show(
+                f"Error in deleting documents. Details: {'; '.join(errors)}",
+                type="error",
+                duration=NOTIFICATION_DURATION,
+            )
+        else:
+            ui.notification_show(
+                "Documents deleted successfully.",
                 type="message",
                 duration=NOTIFICATION_DURATION,
             )
@@ -130,7 +274,11 @@ def server(input: Inputs, output: Outputs, session: Session):
     @reactive.effect
     @reactive.event(input.goto_create_collection)
     def _():
-        ui.modal_show(views.create_collection_modal())
+        ui.modal_show(
+            views.create_collection_modal(
+                reduced_precision=client_obj.backend.supports_reduced_precision
+            )
+        )
 
     @reactive.effect
     @reactive.event(input.create_collection)
@@ -144,7 +292,14 @@ def server(input: Inputs, output: Outputs, session: Session):
             )
         else:
             err = client_obj.create_collection(
-                name=input.collection_name(), description=input.collection_description()
+                name=input.collection_name(),
+                description=input.collection_description(),
+                embedding_dim=int(input.collection_embedding_dim()),
+                embedding_precision=EmbeddingPrecision(
+                    input.collection_embedding_precision()
+                )
+                if client_obj.backend.supports_reduced_precision
+                else EmbeddingPrecision.FLOAT32,
             )
 
             if err is not None:
@@ -160,8 +315,7 @@ def server(input: Inputs, output: Outputs, session: Session):
                     duration=NOTIFICATION_DURATION,
                 )
 
-                collection_list.set(client_obj.list_collections())
-                ui.update_select(id="collection", choices=collection_list())
+                refresh_collections()
 
                 ui.modal_remove()
 
@@ -177,11 +331,23 @@ def server(input: Inputs, output: Outputs, session: Session):
             )
             ui.update_task_button("add_document", state="ready")
 
-        elif not validate_splitter_args(
-            input.splitter_chunk_size()
-        ) or not validate_splitter_args(input.splitter_chunk_overlap()):
+        elif (
+            not validate_splitter_args(input.splitter_chunk_size())
+            or not validate_splitter_args(input.splitter_chunk_overlap())
+            or not validate_splitter_args(input.csv_block_tokens())
+            or not validate_splitter_args(input.parent_chunk_size())
+        ):
             ui.notification_show(
-                "Either chunk size or chunk overlap is invalid. Inputs must be positive integer",
+                "Either chunk size, chunk overlap, parent span size or tokens per block is invalid. "
+                "Inputs must be positive integer",
+                type="error",
+                duration=NOTIFICATION_DURATION,
+            )
+            ui.update_task_button("add_document", state="ready")
+
+        elif input.splitter_chunk_overlap() >= input.splitter_chunk_size():
+            ui.notification_show(
+                "Chunk overlap must be smaller than chunk size",
                 type="error",
                 duration=NOTIFICATION_DURATION,
             )
@@ -205,22 +371,58 @@ def server(input: Inputs, output: Outputs, session: Session):
 
                 ui.update_task_button("add_document", state="ready")
             else:
-                paths = [file["datapath"] for file in files]
-
-                docs, _ = load_docs(paths=paths)
-
-                chunks = split_docs(
-                    docs=docs,
-                    chunk_size=input.splitter_chunk_size(),
-                    chunk_overlap=input.splitter_chunk_overlap(),
-                )
-
-                # TODO: for now, skip doc description
-                err = client_obj.add_documents(
-                    collection_name=input.collection(),
-                    documents=chunks,
-                    description=None,
-                )
+                embed_columns = [
+                    c.strip() for c in input.csv_embed_columns().split(",") if c.strip()
+                ]
+
+                # each file is added as its own document so it can be filtered and removed alone
+                errors = []
+                for file in files:
+                    path = file["datapath"]
+                    parents = None
+
+                    # csv files are streamed as row blocks instead of one document per row
+                    if input.csv_as_blocks() and path.split(".")[-1] == FileType.CSV:
+                        chunks, err = load_csv_blocks(
+                            path=path,
+                            block_tokens=input.csv_block_tokens(),
+                            embed_columns=embed_columns or None,
+                        )
+                    elif input.parent_retrieval():
+                        docs, err = load_docs(paths=[path])
+                        parents, chunks = split_docs_into_parents(
+                            docs=docs,
+                            parent_chunk_size=input.parent_chunk_size(),
+                            chunk_size=input.splitter_chunk_size(),
+                            chunk_overlap=input.splitter_chunk_overlap(),
+                            unit=SplitterUnit(input.splitter_unit()),
+                        )
+                    else:
+                        docs, err = load_docs(paths=[path])
+                        chunks = split_docs(
+                            docs=docs,
+                            chunk_size=input.splitter_chunk_size(),
+                            chunk_overlap=input.splitter_chunk_overlap(),
+                            unit=SplitterUnit(input.splitter_unit()),
+                        )
+
+                    # TODO: for now, skip doc description
+                    if err is None:
+                        err = client_obj.add_documents(
+                            collection_name=active_collection(),
+                            documents=chunks,
+                            description=None,
+                            source=file["name"],
+                            file_hash=file_sha256(path),
+                            size=file["size"],
+                            parents=parents,
+                        )
+
+                    if err is not None:
+                        errors.append(f"{file['name']}: {err}")
+
+                err = "; ".join(errors) if errors else None
+                document_list.set(client_obj.list_documents(active_collection()))
 
                 if err is None:
                     ui.notification_show(
@@ -230,7 +432,7 @@ def server(input: Inputs, output: Outputs, session: Session):
 
                     ui.update_task_button("add_document", state="ready")
 
-                    desc, _ = client_obj.describe_collection(input.collection())
+                    desc, _ = client_obj.describe_collection(active_collection())
                     collection_desc.set(desc)
 
                     ui.modal_remove()
@@ -246,11 +448,13 @@ def server(input: Inputs, output: Outputs, session: Session):
     @reactive.effect
     @reactive.event(input.set_params)
     def _():
-        if collection_list():
-            desc = collection_desc()
-            if desc.num_chunks == 0:
+        names = list(input.collection())
+        if names:
+            descs = [client_obj.describe_collection(name)[0] for name in names]
+            names = [desc.name for desc in descs if desc.num_chunks]
+            if not names:
                 ui.notification_show(
-                    "No documents added yet. Please documents to this collection",
+                    "No documents added yet. Please documents to the selected collection(s)",
                     duration=NOTIFICATION_DURATION,
                     type="error",
                 )
@@ -258,20 +462,30 @@ def server(input: Inputs, output: Outputs, session: Session):
 
             else:
                 retriever = create_retrieval(
-                    client=client_obj.client,
-                    collection_name=input.collection(),
+                    backend=client_obj.backend,
+                    registry=client_obj.registry,
+                    collection_names=names,
+                    document_tags={active_collection(): list(input.documents())},
                 )
+                layout = (
+                    PromptLayout.PREFIX_STABLE
+                    if input.stable_prefix()
+                    else PromptLayout.DEFAULT
+                )
+                prompt_layout.set(layout)
                 chain.set(
                     create_chain(
                         ollama_model_name=input.model(),
                         retriever=retriever,
                         temperature=input.llm_temp(),
+                        speculative_retrieval=input.speculative_retrieval(),
+                        prompt_layout=layout,
                     )
                 )
 
                 time.sleep(2)
                 ui.notification_show(
-                    f"Collection {desc.name} is set as context. Enjoy chatting with Ragapp!",
+                    f"Collection(s) {', '.join(names)} set as context. Enjoy chatting with Ragapp!",
                     duration=NOTIFICATION_DURATION,
                 )
                 ui.update_task_button("set_params", state="ready")
@@ -280,10 +494,69 @@ def server(input: Inputs, output: Outputs, session: Session):
             views.no_selected_collection_message(duration=NOTIFICATION_DURATION)
             ui.update_task_button("set_params", state="ready")
 
+    @reactive.poll(client_obj.changes.last_id, CHANGE_POLL_INTERVAL)
+    def changes():
+        return client_obj.sync()
+
     @reactive.effect
     def _():
-        desc, _ = client_obj.describe_collection(input.collection())
+        # collections and documents changed by other sessions, possibly in other workers
+        events = changes()
+        if not events:
+            return
+
+        refresh_collections()
+
+        with reactive.isolate():
+            name = active_collection()
+            if name is not None and name in {event.collection for event in events}:
+                desc, _ = client_obj.describe_collection(name)
+                collection_desc.set(desc)
+                document_list.set(client_obj.list_documents(name))
+
+    @reactive.effect
+    def _():
+        if active_collection() is None:
+            collection_desc.set(CollectionDescription())
+            document_list.set([])
+            return
+
+        desc, _ = client_obj.describe_collection(active_collection())
         collection_desc.set(desc)
+        document_list.set(client_obj.list_documents(active_collection()))
+
+    async def trim_display(session_id: str):
+        # the ui transcript would otherwise grow for as long as the session runs
+        if len(chat.messages()) > CHAT_DISPLAY_MAX_MESSAGES:
+            display_size.set(CHAT_DISPLAY_PAGE_SIZE)
+            await show_session(session_id)
+
+    async def show_session(session_id: str | None):
+        # only the most recent page of a resumed session is loaded into the ui
+        await chat.clear_messages()
+        if session_id is not None:
+            for msg in session_store.load_recent(
+                session_id, client_id(), limit=display_size()
+            ):
+                await chat.append_message({"role": msg.role, "content": msg.content})
+
+    @reactive.effect
+    @reactive.event(input.chat_session)
+    async def _():
+        session_id = input.chat_session() or None
+        if session_id == current_session():
+            return
+
+        current_session.set(session_id)
+        display_size.set(CHAT_DISPLAY_PAGE_SIZE)
+        await show_session(session_id)
+
+    @reactive.effect
+    @reactive.event(input.load_older)
+    async def _():
+        if current_session() is not None:
+            display_size.set(display_size() + CHAT_DISPLAY_PAGE_SIZE)
+            await show_session(current_session())
 
     @chat.on_user_submit
     def _():
@@ -292,21 +565,47 @@ def server(input: Inputs, output: Outputs, session: Session):
 
     @chat.on_user_submit
     async def _():
-        # TODO: add token limits to narrow down chat history and what is passed to llm
-        messages = chat.messages(format=MessageFormat.LANGCHAIN, token_limits=None)
+        query = chat.user_input()
+        # read here, as the stream's completion callback runs outside the reactive context
+        client = client_id()
+
+        session_id = current_session()
+        if session_id is None:
+            session_id = session_store.create_session(
+                app=APP_NAME, client_id=client, title=query[:50]
+            )
+            current_session.set(session_id)
 
-        curr_chain = chain()
+        # history comes from the store, bounded by tokens, rather than the full ui transcript
+        load_history = (
+            session_store.load_stable_window
+            if prompt_layout() == PromptLayout.PREFIX_STABLE
+            else session_store.load_window
+        )
+        chat_history = to_langchain_messages(
+            load_history(session_id, client, max_tokens=CHAT_HISTORY_MAX_TOKENS)
+        )
+        session_store.append_message(session_id, client, role="user", content=query)
+        await trim_display(session_id)
 
-        # messages contain all chat history; grab the current user query
-        query = messages[-1].content
-        response = curr_chain.stream(
+        curr_chain = chain()
+        # astream keeps the event loop free: the retrieval steps run in executor threads, so
+        # queries of concurrent sessions overlap and share query-embedding batches
+        response = curr_chain.astream(
             {
                 "input": query,
-                "chat_history": list(messages),
+                "chat_history": chat_history,
             }
         )
 
-        await chat.append_message_stream(stream_response(response=response, rag=True))
+        await chat.append_message_stream(
+            arecord_stream(
+                astream_response(response),
+                on_complete=lambda answer: session_store.append_message(
+                    session_id, client, role="assistant", content=answer
+                ),
+            )
+        )
 
 
 app = App(app_ui, server)
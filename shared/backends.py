@@ -0,0 +1,936 @@
+import fcntl
+import json
+import math
+import os
+import shutil
+import sqlite3
+import threading
+import uuid
+from abc import ABC, abstractmethod
+from collections import Counter
+from contextlib import closing, contextmanager
+from dataclasses import dataclass
+from itertools import batched
+from typing import Any, Iterable, Iterator
+
+import chromadb
+import faiss
+import numpy as np
+from langchain_chroma import Chroma
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+from shared.defns import (
+    CHROMA_DB_PERSISTENT_DIR,
+    CHROMA_SERVER_HOST,
+    CHROMA_SERVER_PORT,
+    FAISS_DB_PERSISTENT_DIR,
+    FAISS_DEFAULT_INDEX_TYPE,
+    FAISS_IVF_NPROBE,
+    FAISS_QUANTIZE_THRESHOLD,
+    VECTOR_BACKEND,
+    EmbeddingPrecision,
+    FaissIndexType,
+    VectorBackendType,
+)
+
+
+@dataclass
+class Records:
+    ids: list[str]
+    texts: list[str]
+    metadatas: list[dict[str, Any]]
+    vectors: np.ndarray
+
+
+class VectorBackend(ABC):
+    """Storage for named collections of embedded chunks.
+
+    Backends raise on failure; CollectionClient turns exceptions into Error values.
+    """
+
+    # whether the backend stores float16 / int8 codes for collections with a lower
+    # embedding precision; others would store the same float32 vectors, only less accurate
+    supports_reduced_precision: bool = False
+
+    @abstractmethod
+    def list_collections(self) -> list[str]: ...
+
+    @abstractmethod
+    def create_collection(self, name: str, metadata: dict[str, Any]) -> None: ...
+
+    @abstractmethod
+    def delete_collection(self, name: str) -> None: ...
+
+    @abstractmethod
+    def get_metadata(self, name: str) -> dict[str, Any]: ...
+
+    @abstractmethod
+    def count(self, name: str) -> int: ...
+
+    @abstractmethod
+    def delete(self, name: str, where: dict[str, Any]) -> None: ...
+
+    @abstractmethod
+    def delete_ids(self, name: str, ids: list[str]) -> None: ...
+
+    @abstractmethod
+    def vectorstore(self, name: str, embedding: Embeddings) -> VectorStore: ...
+
+    @abstractmethod
+    def rename_collection(self, name: str, new_name: str) -> None: ...
+
+    @abstractmethod
+    def iter_records(self, name: str, batch_size: int) -> Iterator[Records]:
+        """Yield the stored chunks, with their vectors, in batches."""
+
+    @abstractmethod
+    def add_records(self, name: str, records: Records) -> None:
+        """Write already-embedded chunks, bypassing the embedding model."""
+
+    def invalidate(self, name: str) -> None:
+        """Drop in-process caches of a collection changed by another session or worker."""
+
+
+class ChromaBackend(VectorBackend):
+    def __init__(
+        self,
+        path: str = CHROMA_DB_PERSISTENT_DIR,
+        host: str | None = CHROMA_SERVER_HOST,
+        port: int = CHROMA_SERVER_PORT,
+    ):
+        # the embedded client is single-process: each process holds its own copy of the
+        # hnsw index and its own write queue, so only a server can be shared by workers
+        if host is not None:
+            self.client = chromadb.HttpClient(host=host, port=port)
+        else:
+            self.client = chromadb.PersistentClient(path=path)
+
+    def list_collections(self) -> list[str]:
+        return self.client.list_collections()
+
+    def create_collection(self, name: str, metadata: dict[str, Any]) -> None:
+        _ = self.client.create_collection(
+            name=name,
+            metadata=metadata,
+            get_or_create=False,
+        )
+
+    def delete_collection(self, name: str) -> None:
+        self.client.delete_collection(name=name)
+
+    def get_metadata(self, name: str) -> dict[str, Any]:
+        return self.client.get_collection(name=name).metadata
+
+    def count(self, name: str) -> int:
+        return self.client.get_collection(name=name).count()
+
+    def delete(self, name: str, where: dict[str, Any]) -> None:
+        self.client.get_collection(name=name).delete(where=where)
+
+    def delete_ids(self, name: str, ids: list[str]) -> None:
+        self.client.get_collection(name=name).delete(ids=ids)
+
+    def vectorstore(self, name: str, embedding: Embeddings) -> VectorStore:
+        # chroma object from langchain is used here because documents are of type langchain
+        # Document; it will also integrate with retriever well
+        return Chroma(
+            client=self.client,
+            collection_name=name,
+            embedding_function=embedding,
+        )
+
+    def rename_collection(self, name: str, new_name: str) -> None:
+        self.client.get_collection(name=name).modify(name=new_name)
+
+    def iter_records(self, name: str, batch_size: int) -> Iterator[Records]:
+        collection = self.client.get_collection(name=name)
+
+        for offset in range(0, collection.count(), batch_size):
+            batch = collection.get(
+                include=["embeddings", "documents", "metadatas"],
+                limit=batch_size,
+                offset=offset,
+            )
+            yield Records(
+                ids=batch["ids"],
+                texts=batch["documents"],
+                metadatas=[m or {} for m in batch["metadatas"]],
+                vectors=np.asarray(batch["embeddings"], dtype=np.float32),
+            )
+
+    def invalidate(self, name: str) -> None:
+        # nothing to drop: with a chroma server every read goes through it, and the embedded
+        # store is only supported in a single worker, where all changes are local
+        pass
+
+    def add_records(self, name: str, records: Records) -> None:
+        self.client.get_collection(name=name).add(
+            ids=records.ids,
+            embeddings=records.vectors,
+            documents=records.texts,
+            # chroma rejects empty metadata dicts
+            metadatas=[m or None for m in records.metadatas],
+        )
+
+
+# read-only segment indices shared by every session of the process, keyed by segment path;
+# segments are immutable, the mtime check only guards a path reused by a re-created collection
+_SEGMENT_CACHE: dict[str, tuple[int, faiss.Index]] = {}
+_SEGMENT_CACHE_LOCK = threading.Lock()
+_WRITE_LOCK = threading.Lock()
+
+
+def _pq_subquantizers(dim: int) -> int:
+    # pq needs the dimension to be divisible by the number of sub-quantizers
+    for m in (64, 48, 32, 16, 8, 4, 2):
+        if dim % m == 0:
+            return m
+
+    return 1
+
+
+def _unit_range_sq8(dim: int) -> faiss.IndexScalarQuantizer:
+    index = faiss.IndexScalarQuantizer(
+        dim, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT
+    )
+    # stored vectors are unit-normalised, so every component lies in [-1, 1]; training on
+    # those two corners fixes the range instead of taking it from whichever batch comes first
+    index.train(np.array([[-1.0] * dim, [1.0] * dim], dtype=np.float32))
+
+    return index
+
+
+def _build_index(
+    index_type: FaissIndexType,
+    dim: int,
+    vectors: np.ndarray,
+    precision: EmbeddingPrecision = EmbeddingPrecision.FLOAT32,
+) -> faiss.Index:
+    match index_type:
+        case FaissIndexType.SQ8:
+            base = _unit_range_sq8(dim)
+
+        case FaissIndexType.IVFPQ:
+            # ~39 training points per centroid is the minimum faiss recommends
+            nlist = max(1, min(4096, len(vectors) // 39))
+            index = faiss.IndexIVFPQ(
+                faiss.IndexFlatIP(dim),
+                dim,
+                nlist,
+                _pq_subquantizers(dim),
+                8,
+                faiss.METRIC_INNER_PRODUCT,
+            )
+            index.train(vectors)
+
+            # ivf indices take ids natively; an IndexIDMap around them would renumber its
+            # id map on remove_ids while the ivf lists keep their entries in place
+            return index
+
+        # exact search; the collection's storage precision decides the code size
+        case _ if precision == EmbeddingPrecision.FLOAT16:
+            base = faiss.IndexScalarQuantizer(
+                dim, faiss.ScalarQuantizer.QT_fp16, faiss.METRIC_INNER_PRODUCT
+            )
+
+        case _ if precision == EmbeddingPrecision.INT8:
+            base = _unit_range_sq8(dim)
+
+        case _:
+            base = faiss.IndexFlatIP(dim)
+
+    if not base.is_trained:
+        base.train(vectors)
+
+    return faiss.IndexIDMap2(base)
+
+
+def _reconstruct(index: faiss.Index, ids: np.ndarray) -> np.ndarray:
+    if len(ids) == 0:
+        return np.empty((0, index.d), dtype=np.float32)
+
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        # ivf lists hold arbitrary (non-sequential) ids, so lookups need a hashtable direct map
+        ivf.set_direct_map_type(faiss.DirectMap.Hashtable)
+
+    return index.reconstruct_batch(ids)
+
+
+def _as_unit_vectors(vectors: Iterable[list[float]]) -> np.ndarray:
+    # inner product over unit vectors is cosine similarity
+    arr = np.ascontiguousarray(np.asarray(list(vectors), dtype=np.float32))
+    faiss.normalize_L2(arr)
+
+    return arr
+
+
+@dataclass(frozen=True)
+class Segment:
+    id: int
+    index_type: FaissIndexType
+    ntotal: int
+    ndeleted: int
+
+    @property
+    def live(self) -> int:
+        return self.ntotal - self.ndeleted
+
+
+class FaissCollection:
+    """A collection on disk: immutable faiss index segments plus a sqlite docstore.
+
+    Every add writes its vectors as a new segment, so ingestion cost grows with the batch,
+    not the collection. A delete only removes docstore rows; the vectors stay in their
+    segment as tombstones that search skips. The newest segments are merged while the one
+    before them is no larger, dropping deleted vectors on the way, so each vector is
+    rewritten O(log n) times and a collection holds O(log n) segments.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.meta_path = os.path.join(path, "meta.json")
+        self.docstore_path = os.path.join(path, "docstore.sqlite3")
+
+    def exists(self) -> bool:
+        return os.path.exists(self.meta_path)
+
+    def create(self, metadata: dict[str, Any]) -> None:
+        os.makedirs(self.path, exist_ok=False)
+
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "CREATE TABLE segments ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "index_type TEXT NOT NULL, "
+                "ntotal INTEGER NOT NULL, "
+                "ndeleted INTEGER NOT NULL DEFAULT 0)"
+            )
+            conn.execute(
+                "CREATE TABLE docs ("
+                "faiss_id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "id TEXT UNIQUE NOT NULL, "
+                "segment INTEGER NOT NULL, "
+                "text TEXT NOT NULL, "
+                "metadata TEXT NOT NULL)"
+            )
+            conn.execute("CREATE INDEX docs_segment ON docs (segment)")
+
+        # written last: the collection exists once its metadata does
+        self.write_metadata(metadata)
+
+    @property
+    def metadata(self) -> dict[str, Any]:
+        with open(self.meta_path) as f:
+            return json.load(f)
+
+    def write_metadata(self, metadata: dict[str, Any]) -> None:
+        tmp_path = f"{self.meta_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(metadata, f)
+        os.replace(tmp_path, self.meta_path)
+
+    def count(self) -> int:
+        with closing(self._connect()) as conn:
+            return conn.execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+
+    def add(
+        self,
+        ids: list[str],
+        texts: list[str],
+        metadatas: list[dict[str, Any]],
+        vectors: np.ndarray,
+    ) -> None:
+        if not ids:
+            return
+
+        written: list[str] = []
+        with self._write_lock():
+            try:
+                with closing(self._connect()) as conn, conn:
+                    segment_id = conn.execute(
+                        "INSERT INTO segments (index_type, ntotal) VALUES (?, ?)",
+                        (FaissIndexType.FLAT, len(ids)),
+                    ).lastrowid
+                    faiss_ids = np.array(
+                        [
+                            conn.execute(
+                                "INSERT INTO docs (id, segment, text, metadata) "
+                                "VALUES (?, ?, ?, ?)",
+                                (id_, segment_id, text, json.dumps(meta)),
+                            ).lastrowid
+                            for id_, text, meta in zip(ids, texts, metadatas)
+                        ],
+                        dtype=np.int64,
+                    )
+
+                    index = _build_index(
+                        FaissIndexType.FLAT,
+                        vectors.shape[1],
+                        vectors,
+                        self._precision(),
+                    )
+                    index.add_with_ids(vectors, faiss_ids)
+                    written.append(self._write_segment(segment_id, index))
+
+                    obsolete = self._compact(conn, written)
+            except Exception:
+                # the docstore rolled back, so nothing references the new segment files
+                self._remove_files(written)
+                raise
+
+            self._remove_files(obsolete)
+
+    def delete(self, where: dict[str, Any] | None = None, ids: list[str] | None = None):
+        if ids is None and not where:
+            return
+
+        with self._write_lock():
+            with closing(self._connect()) as conn, conn:
+                if ids is not None:
+                    rows = conn.execute(
+                        "SELECT faiss_id, segment FROM docs "
+                        f"WHERE id IN ({','.join('?' * len(ids))})",
+                        ids,
+                    ).fetchall()
+                else:
+                    clause, params = self._where_clause(where or {})
+                    rows = conn.execute(
+                        f"SELECT faiss_id, segment FROM docs WHERE {clause}", params
+                    ).fetchall()
+
+                if not rows:
+                    return
+
+                # the vectors stay in their segments until the next merge; without a docstore
+                # row they are skipped by search
+                conn.executemany(
+                    "DELETE FROM docs WHERE faiss_id = ?", [(r[0],) for r in rows]
+                )
+                conn.executemany(
+                    "UPDATE segments SET ndeleted = ndeleted + ? WHERE id = ?",
+                    [
+                        (n, segment)
+                        for segment, n in Counter(r[1] for r in rows).items()
+                    ],
+                )
+                emptied = [
+                    r[0]
+                    for r in conn.execute(
+                        "SELECT id FROM segments WHERE ndeleted >= ntotal"
+                    )
+                ]
+                conn.execute("DELETE FROM segments WHERE ndeleted >= ntotal")
+
+            self._remove_files([self._segment_path(i) for i in emptied])
+
+    def search(
+        self, vector: np.ndarray, k: int, where: dict[str, Any] | None = None
+    ) -> list[tuple[Document, float]]:
+        selector = None
+        if where:
+            # filtered searches only consider the matching vectors; selecting them up front
+            # finds small documents that an over-fetch of the nearest neighbours would miss
+            clause, params = self._where_clause(where)
+            with closing(self._connect()) as conn:
+                rows = conn.execute(
+                    f"SELECT faiss_id FROM docs WHERE {clause}", params
+                ).fetchall()
+            ids = np.array([r[0] for r in rows], dtype=np.int64)
+            if len(ids) == 0:
+                return []
+
+            selector = faiss.IDSelectorBatch(ids)
+
+        hits = []
+        for segment, index in self._open_segments():
+            if index.ntotal == 0:
+                continue
+
+            ivf = faiss.try_extract_index_ivf(index)
+            if selector is None:
+                # over-fetch by the segment's deleted vectors, which the docstore drops
+                fetch_k = min(index.ntotal, k + segment.ndeleted)
+                if ivf is not None:
+                    ivf.nprobe = FAISS_IVF_NPROBE
+                search_params = None
+            else:
+                # deleted vectors are not in the docstore, so the selector skips them too
+                fetch_k = min(index.ntotal, k)
+                if ivf is None:
+                    search_params = faiss.SearchParameters(sel=selector)
+                else:
+                    # probe enough lists to expect k matches were they spread evenly, so a
+                    # selective filter does not come back short
+                    nprobe = max(FAISS_IVF_NPROBE, math.ceil(k * ivf.nlist / len(ids)))
+                    search_params = faiss.SearchParametersIVF(
+                        sel=selector, nprobe=min(nprobe, ivf.nlist)
+                    )
+
+            scores, faiss_ids = index.search(
+                vector.reshape(1, -1), fetch_k, params=search_params
+            )
+            hits.extend(
+                (int(i), float(s)) for i, s in zip(faiss_ids[0], scores[0]) if i != -1
+            )
+
+        hits.sort(key=lambda hit: hit[1], reverse=True)
+
+        results = []
+        with closing(self._connect()) as conn:
+            for batch in batched(hits, 512):
+                query = (
+                    "SELECT faiss_id, id, text, metadata FROM docs "
+                    f"WHERE faiss_id IN ({','.join('?' * len(batch))})"
+                )
+                rows = {r[0]: r[1:] for r in conn.execute(query, [i for i, _ in batch])}
+                for faiss_id, score in batch:
+                    if faiss_id in rows:
+                        id_, text, meta = rows[faiss_id]
+                        results.append(
+                            (
+                                Document(
+                                    id=id_, page_content=text, metadata=json.loads(meta)
+                                ),
+                                score,
+                            )
+                        )
+
+                if len(results) >= k:
+                    break
+
+        return results[:k]
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.docstore_path)
+
+    @contextmanager
+    def _write_lock(self) -> Iterator[None]:
+        # the thread lock serialises sessions of this worker, the file lock other workers
+        with _WRITE_LOCK, open(os.path.join(self.path, "write.lock"), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    def invalidate(self) -> None:
+        # segments are immutable and cached by path and mtime, and merged-away ones are
+        # evicted when the segments are next opened, so live entries stay valid; only drop
+        # the files that are gone (e.g. a collection deleted by another worker), which
+        # nothing would evict otherwise
+        prefix = os.path.join(self.path, "")
+        with _SEGMENT_CACHE_LOCK:
+            for path in [p for p in _SEGMENT_CACHE if p.startswith(prefix)]:
+                if not os.path.exists(path):
+                    del _SEGMENT_CACHE[path]
+
+    @staticmethod
+    def _where_clause(where: dict[str, Any]) -> tuple[str, list[Any]]:
+        # equality and $in filters on top-level metadata keys, a subset of chroma's where
+        if not where:
+            return "1 = 1", []
+
+        clauses, params = [], []
+        for key, value in where.items():
+            if isinstance(value, dict) and "$in" in value:
+                clauses.append(
+                    f"json_extract(metadata, '$.{key}') IN ({','.join('?' * len(value['$in']))})"
+                )
+                params.extend(value["$in"])
+            else:
+                clauses.append(f"json_extract(metadata, '$.{key}') = ?")
+                params.append(value)
+
+        return " AND ".join(clauses), params
+
+    def _segments(self, conn: sqlite3.Connection) -> list[Segment]:
+        return [
+            Segment(id, FaissIndexType(index_type), ntotal, ndeleted)
+            for id, index_type, ntotal, ndeleted in conn.execute(
+                "SELECT id, index_type, ntotal, ndeleted FROM segments ORDER BY id"
+            )
+        ]
+
+    def _segment_path(self, segment_id: int) -> str:
+        return os.path.join(self.path, f"segment-{segment_id:08d}.faiss")
+
+    def _write_segment(self, segment_id: int, index: faiss.Index) -> str:
+        path = self._segment_path(segment_id)
+        tmp_path = f"{path}.tmp"
+        faiss.write_index(index, tmp_path)
+        os.replace(tmp_path, path)
+
+        return path
+
+    @staticmethod
+    def _remove_files(paths: list[str]) -> None:
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _open_segments(self) -> list[tuple[Segment, faiss.Index]]:
+        for _ in range(3):
+            with closing(self._connect()) as conn:
+                segments = self._segments(conn)
+
+            try:
+                opened = [(s, self._load_readonly(s)) for s in segments]
+            except FileNotFoundError:
+                # a writer merged segments between listing and opening them; list again
+                continue
+
+            # merged-away segments of this collection are no longer needed in the cache
+            prefix = os.path.join(self.path, "")
+            current = {self._segment_path(s.id) for s in segments}
+            with _SEGMENT_CACHE_LOCK:
+                for path in [p for p in _SEGMENT_CACHE if p.startswith(prefix)]:
+                    if path not in current:
+                        del _SEGMENT_CACHE[path]
+
+            return opened
+
+        raise RuntimeError(f"Segments of {self.path} kept changing while being opened")
+
+    def _load_readonly(self, segment: Segment) -> faiss.Index:
+        path = self._segment_path(segment.id)
+        mtime = os.stat(path).st_mtime_ns
+
+        with _SEGMENT_CACHE_LOCK:
+            cached = _SEGMENT_CACHE.get(path)
+            if cached is not None and cached[0] == mtime:
+                return cached[1]
+
+            if segment.index_type == FaissIndexType.IVFPQ:
+                # the inverted lists of large quantized segments are memory-mapped and paged
+                # in on demand; flat and sq segments have no mmap support and are read whole
+                try:
+                    index = faiss.read_index(
+                        path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+                    )
+                except RuntimeError:
+                    index = faiss.read_index(path)
+            else:
+                index = faiss.read_index(path)
+
+            _SEGMENT_CACHE[path] = (mtime, index)
+
+        return index
+
+    def _precision(self) -> EmbeddingPrecision:
+        return EmbeddingPrecision(
+            self.metadata.get("embedding_precision", EmbeddingPrecision.FLOAT32)
+        )
+
+    def _compact(self, conn: sqlite3.Connection, written: list[str]) -> list[str]:
+        # merge the newest segments while the one before them is no larger than their sum,
+        # like carrying in a binary counter; returns the files the merge made obsolete
+        segments = self._segments(conn)
+        run = [segments.pop()]
+        while segments and segments[-1].live <= sum(s.live for s in run):
+            run.insert(0, segments.pop())
+
+        if len(run) == 1:
+            return []
+
+        merged_id = conn.execute(
+            "INSERT INTO segments (index_type, ntotal) VALUES (?, 0)",
+            (FaissIndexType.FLAT,),
+        ).lastrowid
+        index, index_type = self._merge(conn, run)
+        written.append(self._write_segment(merged_id, index))
+
+        run_ids = [s.id for s in run]
+        placeholders = ",".join("?" * len(run_ids))
+        conn.execute(
+            "UPDATE segments SET index_type = ?, ntotal = ? WHERE id = ?",
+            (index_type, index.ntotal, merged_id),
+        )
+        conn.execute(
+            f"UPDATE docs SET segment = ? WHERE segment IN ({placeholders})",
+            [merged_id, *run_ids],
+        )
+        conn.execute(f"DELETE FROM segments WHERE id IN ({placeholders})", run_ids)
+
+        return [self._segment_path(i) for i in run_ids]
+
+    def _merge(
+        self, conn: sqlite3.Connection, run: list[Segment]
+    ) -> tuple[faiss.Index, FaissIndexType]:
+        live_ids = {
+            s.id: np.array(
+                [
+                    r[0]
+                    for r in conn.execute(
+                        "SELECT faiss_id FROM docs WHERE segment = ? ORDER BY faiss_id",
+                        (s.id,),
+                    )
+                ],
+                dtype=np.int64,
+            )
+            for s in run
+        }
+        indices = {s.id: faiss.read_index(self._segment_path(s.id)) for s in run}
+        target_type = FaissIndexType(
+            self.metadata.get("index_type", FaissIndexType.FLAT)
+        )
+
+        quantized = [s for s in run if s.index_type != FaissIndexType.FLAT]
+        if quantized:
+            # an already quantized segment keeps its trained codebooks and absorbs the others;
+            # vectors of a second quantized segment are re-encoded from their reconstruction
+            base = max(quantized, key=lambda s: s.live)
+            index = indices.pop(base.id)
+            keep = faiss.IDSelectorBatch(live_ids.pop(base.id))
+            index.remove_ids(faiss.IDSelectorNot(keep))
+            for segment_id, ids in live_ids.items():
+                if len(ids):
+                    index.add_with_ids(_reconstruct(indices[segment_id], ids), ids)
+
+            return index, base.index_type
+
+        ids = np.concatenate([live_ids[s.id] for s in run])
+        vectors = np.vstack([_reconstruct(indices[s.id], live_ids[s.id]) for s in run])
+        if target_type != FaissIndexType.FLAT and len(ids) >= FAISS_QUANTIZE_THRESHOLD:
+            # the merged segment is large enough to train the collection's quantized index on
+            index = _build_index(target_type, vectors.shape[1], vectors)
+            index_type = target_type
+        else:
+            index = _build_index(
+                FaissIndexType.FLAT, vectors.shape[1], vectors, self._precision()
+            )
+            index_type = FaissIndexType.FLAT
+
+        index.add_with_ids(vectors, ids)
+
+        return index, index_type
+
+    def iter_records(self, batch_size: int) -> Iterator[Records]:
+        indices: dict[int, faiss.Index] = {}
+        failed: set[int] | None = None
+
+        last_id = 0
+        while True:
+            with closing(self._connect()) as conn:
+                rows = conn.execute(
+                    "SELECT faiss_id, id, text, metadata, segment FROM docs "
+                    "WHERE faiss_id > ? ORDER BY faiss_id LIMIT ?",
+                    (last_id, batch_size),
+                ).fetchall()
+
+            if not rows:
+                return
+
+            segment_ids = {r[4] for r in rows}
+            try:
+                for segment_id in segment_ids - indices.keys():
+                    indices[segment_id] = faiss.read_index(
+                        self._segment_path(segment_id)
+                    )
+            except RuntimeError:
+                # a merge replaced a segment between reading the rows and opening it; the
+                # rows read again point at the merged segment
+                if segment_ids == failed:
+                    raise
+                failed = segment_ids
+                continue
+
+            vectors = np.empty((len(rows), indices[rows[0][4]].d), dtype=np.float32)
+            for segment_id in segment_ids:
+                picked = [i for i, r in enumerate(rows) if r[4] == segment_id]
+                vectors[picked] = _reconstruct(
+                    indices[segment_id],
+                    np.array([rows[i][0] for i in picked], dtype=np.int64),
+                )
+
+            last_id = rows[-1][0]
+            yield Records(
+                ids=[r[1] for r in rows],
+                texts=[r[2] for r in rows],
+                metadatas=[json.loads(r[3]) for r in rows],
+                vectors=vectors,
+            )
+
+
+class FaissVectorStore(VectorStore):
+    def __init__(self, collection: FaissCollection, embedding: Embeddings):
+        self.collection = collection
+        self.embedding = embedding
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self.embedding
+
+    def add_texts(
+        self,
+        texts: Iterable[str],
+        metadatas: list[dict] | None = None,
+        ids: list[str] | None = None,
+        **kwargs: Any,
+    ) -> list[str]:
+        texts = list(texts)
+        metadatas = metadatas or [{} for _ in texts]
+        ids = ids or [str(uuid.uuid4()) for _ in texts]
+
+        vectors = _as_unit_vectors(self.embedding.embed_documents(texts))
+        self.collection.add(ids=ids, texts=texts, metadatas=metadatas, vectors=vectors)
+
+        return ids
+
+    def delete(self, ids: list[str] | None = None, **kwargs: Any) -> None:
+        self.collection.delete(ids=ids, where=kwargs.get("where"))
+
+    def similarity_search_by_vector_with_relevance_scores(
+        self,
+        embedding: list[float],
+        k: int = 4,
+        filter: dict[str, Any] | None = None,
+        **kwargs: Any,
+    ) -> list[tuple[Document, float]]:
+        # like chroma's method of the same name, the scores are raw (cosine similarity here);
+        # _select_relevance_score_fn turns them into relevance
+        vector = _as_unit_vectors([embedding])[0]
+
+        return self.collection.search(vector=vector, k=k, where=filter)
+
+    def similarity_search_with_score(
+        self,
+        query: str,
+        k: int = 4,
+        filter: dict[str, Any] | None = None,
+        **kwargs: Any,
+    ) -> list[tuple[Document, float]]:
+        return self.similarity_search_by_vector_with_relevance_scores(
+            self.embedding.embed_query(query), k=k, filter=filter
+        )
+
+    def similarity_search(
+        self,
+        query: str,
+        k: int = 4,
+        filter: dict[str, Any] | None = None,
+        **kwargs: Any,
+    ) -> list[Document]:
+        return [
+            doc
+            for doc, _ in self.similarity_search_with_score(
+                query=query, k=k, filter=filter
+            )
+        ]
+
+    def _select_relevance_score_fn(self):
+        # cosine similarity in [-1, 1] to relevance in [0, 1]
+        return lambda score: (score + 1.0) / 2.0
+
+    @classmethod
+    def from_texts(
+        cls,
+        texts: list[str],
+        embedding: Embeddings,
+        metadatas: list[dict] | None = None,
+        *,
+        ids: list[str] | None = None,
+        collection_name: str = "langchain",
+        collection_metadata: dict[str, Any] | None = None,
+        backend: "FaissBackend | None" = None,
+        **kwargs: Any,
+    ) -> "FaissVectorStore":
+        backend = backend if backend is not None else FaissBackend()
+        if collection_name not in backend.list_collections():
+            backend.create_collection(
+                name=collection_name, metadata=collection_metadata or {}
+            )
+
+        store = backend.vectorstore(name=collection_name, embedding=embedding)
+        store.add_texts(texts=texts, metadatas=metadatas, ids=ids)
+
+        return store
+
+
+class FaissBackend(VectorBackend):
+    supports_reduced_precision = True
+
+    def __init__(
+        self,
+        path: str = FAISS_DB_PERSISTENT_DIR,
+        index_type: FaissIndexType = FAISS_DEFAULT_INDEX_TYPE,
+    ):
+        self.path = path
+        self.index_type = index_type
+        os.makedirs(path, exist_ok=True)
+
+    def list_collections(self) -> list[str]:
+        return sorted(
+            name
+            for name in os.listdir(self.path)
+            if self._collection(name, must_exist=False).exists()
+        )
+
+    def create_collection(self, name: str, metadata: dict[str, Any]) -> None:
+        if self._collection(name, must_exist=False).exists():
+            raise ValueError(f"Collection {name} already exists")
+
+        # an explicit index type (e.g. copied from a collection being re-indexed) wins over
+        # the backend default
+        metadata = {"index_type": self.index_type, **metadata}
+        self._collection(name, must_exist=False).create(metadata)
+
+    def delete_collection(self, name: str) -> None:
+        shutil.rmtree(self._collection(name).path)
+
+    def get_metadata(self, name: str) -> dict[str, Any]:
+        return self._collection(name).metadata
+
+    def count(self, name: str) -> int:
+        return self._collection(name).count()
+
+    def delete(self, name: str, where: dict[str, Any]) -> None:
+        self._collection(name).delete(where=where)
+
+    def delete_ids(self, name: str, ids: list[str]) -> None:
+        self._collection(name).delete(ids=ids)
+
+    def vectorstore(self, name: str, embedding: Embeddings) -> VectorStore:
+        return FaissVectorStore(collection=self._collection(name), embedding=embedding)
+
+    def rename_collection(self, name: str, new_name: str) -> None:
+        target = self._collection(new_name, must_exist=False)
+        if target.exists():
+            raise ValueError(f"Collection {new_name} already exists")
+
+        os.rename(self._collection(name).path, target.path)
+
+    def iter_records(self, name: str, batch_size: int) -> Iterator[Records]:
+        yield from self._collection(name).iter_records(batch_size=batch_size)
+
+    def invalidate(self, name: str) -> None:
+        # the collection may have been deleted; build the path without checking it exists
+        self._collection(name, must_exist=False).invalidate()
+
+    def add_records(self, name: str, records: Records) -> None:
+        self._collection(name).add(
+            ids=records.ids,
+            texts=records.texts,
+            metadatas=records.metadatas,
+            vectors=_as_unit_vectors(records.vectors),
+        )
+
+    def _collection(self, name: str, must_exist: bool = True) -> FaissCollection:
+        if os.sep in name or name in ("", ".", ".."):
+            raise ValueError(f"Invalid collection name {name}")
+
+        collection = FaissCollection(os.path.join(self.path, name))
+        if must_exist and not collection.exists():
+            raise ValueError(f"Collection {name} does not exist")
+
+        return collection
+
+
+def get_default_backend() -> VectorBackend:
+    match VECTOR_BACKEND:
+        case VectorBackendType.FAISS:
+            return FaissBackend()
+
+        case _:
+            return ChromaBackend()
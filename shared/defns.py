@@ -20,14 +20,121 @@ class DocSplitterDefaultArgs(IntEnum):
     CHUNK_OVERLAP = 200
 
 
+class TokenSplitterDefaultArgs(IntEnum):
+    CHUNK_SIZE = 256
+    CHUNK_OVERLAP = 32
+
+
+class ParentSplitterDefaultArgs(IntEnum):
+    CHUNK_SIZE = 1024  # tokens
+    CONTEXT_MAX_TOKENS = 2048  # budget for expanded parents passed to the llm
+
+
+class CsvBlockDefaultArgs(IntEnum):
+    BLOCK_TOKENS = 256
+    READ_CHUNK_ROWS = 10_000
+
+
+class SplitterUnit(StrEnum):
+    CHARACTER = auto()
+    TOKEN = auto()
+
+
+class VectorBackendType(StrEnum):
+    CHROMA = auto()
+    FAISS = auto()
+
+
+class FaissIndexType(StrEnum):
+    FLAT = auto()
+    SQ8 = auto()  # int8 scalar quantization, 4x smaller than flat
+    IVFPQ = auto()  # inverted file + product quantization, for very large collections
+
+
+class EmbeddingPrecision(StrEnum):
+    FLOAT32 = auto()
+    FLOAT16 = auto()
+    INT8 = auto()
+
+
+class ChangeKind(StrEnum):
+    COLLECTION_CREATED = auto()
+    COLLECTION_DELETED = auto()
+    COLLECTION_REINDEXED = auto()
+    DOCUMENTS_ADDED = auto()
+    DOCUMENTS_DELETED = auto()
+
+
+class PromptLayout(StrEnum):
+    DEFAULT = auto()
+    # history first, retrieved context last, so the prompt prefix only grows between turns
+    PREFIX_STABLE = auto()
+
+
 class MessageFormat(StrEnum):
     OLLAMA = auto()
     LANGCHAIN = auto()
 
 
 OLLAMA_EMBEDDING_NAME = "nomic-embed-text"
+EMBEDDING_DIM = 768
+# nomic-embed-text is trained matryoshka-style, so its vectors can be truncated to these widths
+MATRYOSHKA_DIMS = (768, 512, 256, 128, 64)
+# huggingface tokenizer matching the ollama embedding above; used to measure chunks in tokens
+EMBEDDING_TOKENIZER_NAME = "nomic-ai/nomic-embed-text-v1.5"
 CHROMA_DB_PERSISTENT_DIR = "./db"
+# set to use a chroma server instead of the embedded store; required to run several workers
+# on chroma, since the embedded store keeps its index and write queue inside one process
+CHROMA_SERVER_HOST: str | None = None
+CHROMA_SERVER_PORT = 8000
+FAISS_DB_PERSISTENT_DIR = "./faiss_db"
+VECTOR_BACKEND = VectorBackendType.CHROMA
+FAISS_DEFAULT_INDEX_TYPE = FaissIndexType.FLAT
+# quantized faiss segments are only built once merged segments hold this many chunks;
+# smaller segments stay exact (flat) since quantization needs enough training points
+FAISS_QUANTIZE_THRESHOLD = 10_000
+FAISS_IVF_NPROBE = 16
+# vectors are copied between collections (re-index, import) in batches of this size
+RECORD_BATCH_SIZE = 4096
+SNAPSHOT_FORMAT_VERSION = 1
+# documents are embedded and written in batches of this size so ingestion memory stays bounded
+EMBEDDING_BATCH_SIZE = 256
+# query embeddings from all sessions are batched into one request: a batch is sent once it
+# holds this many queries or the first query has waited this many milliseconds
+QUERY_BATCH_MAX_SIZE = 32
+QUERY_BATCH_MAX_WAIT_MS = 5
+# federated retrieval over several collections: per-collection deadline (seconds) and fan-out
+FEDERATED_RETRIEVAL_TIMEOUT = 5.0
+FEDERATED_MAX_WORKERS = 8
+RETRIEVAL_TOP_K = 4
+# speculative retrieval: word-overlap between the raw and rewritten follow-up query above
+# which the speculative hits are reused as-is, or merged with a retrieval on the rewrite
+SPECULATIVE_REUSE_THRESHOLD = 0.8
+SPECULATIVE_MERGE_THRESHOLD = 0.4
+DOCUMENT_REGISTRY_PATH = "./documents.db"
+# cross-worker change log; sessions poll it every CHANGE_POLL_INTERVAL seconds
+CHANGE_LOG_PATH = "./changes.db"
+CHANGE_LOG_MAX_EVENTS = 10_000
+CHANGE_POLL_INTERVAL = 2
+SESSION_DB_PATH = "./sessions.db"
+# browser localStorage key holding the random id that chat sessions are scoped to
+CLIENT_ID_STORAGE_KEY = "chatty-client-id"
+# chat history sent to the llm is the newest messages fitting this many (estimated) tokens
+CHAT_HISTORY_MAX_TOKENS = 2048
+# chat message tokens are estimated from their length, which needs no tokenizer download;
+# ~4 characters per token holds for the llama-style vocabularies of the chat models
+CHARS_PER_TOKEN = 4
+# messages shown when a session is resumed, and added per "load older messages" click
+CHAT_DISPLAY_PAGE_SIZE = 20
+# once the chat shows more messages than this, it is reset to the latest page; the full
+# session stays in the session store
+CHAT_DISPLAY_MAX_MESSAGES = 100
+CHAT_SESSION_LIST_SIZE = 20
 NOTIFICATION_DURATION = 5
 DEFAULT_LLM_TEMPERATURE = 0.8
+# every request uses the same context size and keep-alive, so ollama keeps one loaded model
+# (and its kv cache) per model instead of reloading it when the options differ
+OLLAMA_NUM_CTX = 4096
+OLLAMA_KEEP_ALIVE = "30m"
 
 type Error = str | None
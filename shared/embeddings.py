@@ -0,0 +1,165 @@
+import asyncio
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from functools import lru_cache
+from typing import Any
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_ollama import OllamaEmbeddings
+
+from shared.defns import (
+    EMBEDDING_DIM,
+    OLLAMA_EMBEDDING_NAME,
+    QUERY_BATCH_MAX_SIZE,
+    QUERY_BATCH_MAX_WAIT_MS,
+)
+
+
+class EmbeddingBatcher:
+    """Collects texts from concurrent callers and embeds them in one request.
+
+    A single worker thread takes the first queued text, waits up to max_wait_ms for more
+    (or until max_batch texts are queued), embeds the batch and resolves each caller's future.
+    Texts arriving while a batch is in flight form the next batch.
+    """
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        max_batch: int = QUERY_BATCH_MAX_SIZE,
+        max_wait_ms: float = QUERY_BATCH_MAX_WAIT_MS,
+    ):
+        self.embeddings = embeddings
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+
+        self._queue: queue.Queue[tuple[str, Future]] = queue.Queue()
+        self._worker = threading.Thread(
+            target=self._run, name="embedding-batcher", daemon=True
+        )
+        self._worker.start()
+
+    def submit(self, text: str) -> Future:
+        future = Future()
+        self._queue.put((text, future))
+
+        return future
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            # callers that gave up (e.g. a timed-out retrieval) cancel their future; drop them
+            # so a cancelled future is never resolved, which would raise and kill this thread
+            batch = [
+                (text, future)
+                for text, future in batch
+                if future.set_running_or_notify_cancel()
+            ]
+            if not batch:
+                continue
+
+            # sessions often ask the same thing (e.g. a suggested question); embed it once
+            texts = list(dict.fromkeys(text for text, _ in batch))
+            try:
+                vectors = dict(zip(texts, self.embeddings.embed_documents(texts)))
+            except Exception as err:
+                vectors, error = {}, err
+            else:
+                error = None
+
+            for text, future in batch:
+                try:
+                    if error is None:
+                        future.set_result(list(vectors[text]))
+                    else:
+                        future.set_exception(error)
+                except Exception as err:
+                    future.set_exception(err)
+
+
+class BatchedQueryEmbeddings(Embeddings):
+    """Embeddings whose queries go through a shared EmbeddingBatcher.
+
+    Documents are already embedded in batches at ingestion, so they bypass the batcher.
+    """
+
+    def __init__(self, batcher: EmbeddingBatcher):
+        self.batcher = batcher
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self.batcher.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.batcher.submit(text).result()
+
+    async def aembed_query(self, text: str) -> list[float]:
+        return await asyncio.wrap_future(self.batcher.submit(text))
+
+
+@lru_cache(maxsize=1)
+def get_query_embeddings() -> BatchedQueryEmbeddings:
+    # one batcher per process, shared by every session
+    return BatchedQueryEmbeddings(
+        EmbeddingBatcher(OllamaEmbeddings(model=OLLAMA_EMBEDDING_NAME))
+    )
+
+
+def reduce_vectors(vectors: np.ndarray, dim: int) -> np.ndarray:
+    # matryoshka truncation as recommended for nomic-embed: layer-norm each full vector, keep
+    # the leading dims and re-normalise; lower precision is not applied here but by the
+    # backend's index, so vectors are quantized once
+    vectors = np.asarray(vectors, dtype=np.float32)
+    mean = vectors.mean(axis=1, keepdims=True)
+    std = np.sqrt(vectors.var(axis=1, keepdims=True) + 1e-5)
+
+    reduced = ((vectors - mean) / std)[:, :dim]
+    norms = np.linalg.norm(reduced, axis=1, keepdims=True)
+
+    return reduced / np.where(norms == 0, 1, norms)
+
+
+class ReducedEmbeddings(Embeddings):
+    """Truncates the vectors of another Embeddings to a collection's stored width.
+
+    Used identically at ingestion and query time so both sides live in the same space.
+    """
+
+    def __init__(self, base: Embeddings, dim: int):
+        self.base = base
+        self.dim = dim
+
+    def reduce(self, vectors: list[list[float]]) -> list[list[float]]:
+        return reduce_vectors(vectors, self.dim).tolist()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self.reduce(self.base.embed_documents(texts))
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.reduce([self.base.embed_query(text)])[0]
+
+    async def aembed_query(self, text: str) -> list[float]:
+        return self.reduce([await self.base.aembed_query(text)])[0]
+
+
+def embeddings_for_collection(base: Embeddings, metadata: dict[str, Any]) -> Embeddings:
+    # collections created before storage settings existed have no keys and use full vectors
+    dim = metadata.get("embedding_dim", EMBEDDING_DIM)
+    if dim >= EMBEDDING_DIM:
+        return base
+
+    return ReducedEmbeddings(base=base, dim=dim)
@@ -0,0 +1,75 @@
+import os
+import sqlite3
+from contextlib import closing
+from dataclasses import dataclass
+from datetime import datetime
+
+from shared.defns import CHANGE_LOG_MAX_EVENTS, CHANGE_LOG_PATH, ChangeKind
+
+
+@dataclass(frozen=True)
+class ChangeEvent:
+    id: int
+    kind: ChangeKind
+    collection: str
+    pid: int
+    date_created: str
+
+
+class ChangeLog:
+    """Append-only log of collection and document changes, shared by every worker process.
+
+    Writers publish after each successful change; each session polls last_id() and reads the
+    new events to refresh its views and drop stale in-process caches.
+    """
+
+    def __init__(self, path: str = CHANGE_LOG_PATH):
+        self.path = path
+
+        with closing(self._connect()) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS events ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "kind TEXT NOT NULL, "
+                "collection TEXT NOT NULL, "
+                "pid INTEGER NOT NULL, "
+                "date_created TEXT NOT NULL)"
+            )
+
+    def publish(self, kind: ChangeKind, collection: str) -> None:
+        with closing(self._connect()) as conn, conn:
+            event_id = conn.execute(
+                "INSERT INTO events (kind, collection, pid, date_created) "
+                "VALUES (?, ?, ?, ?)",
+                (
+                    kind,
+                    collection,
+                    os.getpid(),
+                    datetime.now().strftime("%Y-%m-%d-%H-%M-%S"),
+                ),
+            ).lastrowid
+            # readers only ever need recent events; keep the log bounded
+            conn.execute(
+                "DELETE FROM events WHERE id <= ?", (event_id - CHANGE_LOG_MAX_EVENTS,)
+            )
+
+    def last_id(self) -> int:
+        with closing(self._connect()) as conn:
+            return conn.execute("SELECT COALESCE(MAX(id), 0) FROM events").fetchone()[0]
+
+    def since(self, event_id: int) -> list[ChangeEvent]:
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT id, kind, collection, pid, date_created FROM events "
+                "WHERE id > ? ORDER BY id",
+                (event_id,),
+            ).fetchall()
+
+        return [
+            ChangeEvent(id, ChangeKind(kind), collection, pid, date_created)
+            for id, kind, collection, pid, date_created in rows
+        ]
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path)
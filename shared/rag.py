@@ -1,26 +1,62 @@
-from typing import Any
+import json
+import re
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from itertools import zip_longest
+from typing import Any, Iterator
 
-import chromadb
+import pandas as pd
 from langchain.chains import (
     create_history_aware_retriever,
     create_retrieval_chain,
 )
 from langchain.chains.combine_documents import create_stuff_documents_chain
-from langchain_chroma import Chroma
 from langchain_community.document_loaders import (
     CSVLoader,
     Docx2txtLoader,
     PyPDFLoader,
     TextLoader,
 )
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
 from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain_core.runnables import Runnable
-from langchain_core.vectorstores import VectorStoreRetriever
-from langchain_ollama import ChatOllama, OllamaEmbeddings
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.runnables import Runnable, RunnableLambda
+from langchain_core.vectorstores import VectorStore
+from langchain_ollama import ChatOllama
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 
-from shared.defns import OLLAMA_EMBEDDING_NAME, DocSplitterDefaultArgs, Error, FileType
+from shared.backends import VectorBackend
+from shared.defns import (
+    FEDERATED_MAX_WORKERS,
+    FEDERATED_RETRIEVAL_TIMEOUT,
+    OLLAMA_KEEP_ALIVE,
+    OLLAMA_NUM_CTX,
+    RETRIEVAL_TOP_K,
+    SPECULATIVE_MERGE_THRESHOLD,
+    SPECULATIVE_REUSE_THRESHOLD,
+    CsvBlockDefaultArgs,
+    DocSplitterDefaultArgs,
+    Error,
+    FileType,
+    ParentSplitterDefaultArgs,
+    PromptLayout,
+    SplitterUnit,
+)
+from shared.embeddings import (
+    ReducedEmbeddings,
+    embeddings_for_collection,
+    get_query_embeddings,
+)
+from shared.registry import DocumentRegistry
+from shared.utils import (
+    PromptEvalLogger,
+    count_tokens,
+    estimate_tokens,
+    get_embedding_tokenizer,
+)
 
 
 def load_docs(paths: list[str]) -> tuple[list[Document], Error]:
@@ -53,11 +89,111 @@ def load_docs(paths: list[str]) -> tuple[list[Document], Error]:
     return docs, None
 
 
+def load_csv_blocks(
+    path: str,
+    block_tokens: int = CsvBlockDefaultArgs.BLOCK_TOKENS,
+    embed_columns: list[str] | None = None,
+    read_chunk_rows: int = CsvBlockDefaultArgs.READ_CHUNK_ROWS,
+) -> tuple[Iterator[Document], Error]:
+    # one document per block of rows rather than per row; the file is read lazily in chunks
+    # so the returned iterator can be streamed straight into embedding
+    try:
+        columns = list(pd.read_csv(path, nrows=0).columns)
+    except Exception as err:
+        return iter(()), f"Error reading csv file. More info: {err}"
+
+    embed_columns = embed_columns or columns
+    missing = [c for c in embed_columns if c not in columns]
+    if missing:
+        return iter(()), f"column(s) {', '.join(missing)} not found in csv file"
+
+    return _iter_csv_blocks(
+        path=path,
+        block_tokens=block_tokens,
+        embed_columns=embed_columns,
+        metadata_columns=[c for c in columns if c not in embed_columns],
+        read_chunk_rows=read_chunk_rows,
+    ), None
+
+
+def _estimate_tokens_batch(texts: list[str]) -> list[int]:
+    return [estimate_tokens(text) for text in texts]
+
+
+def _iter_csv_blocks(
+    path: str,
+    block_tokens: int,
+    embed_columns: list[str],
+    metadata_columns: list[str],
+    read_chunk_rows: int,
+) -> Iterator[Document]:
+    # block sizes only need to be approximate, so fall back to a length estimate when the
+    # tokenizer cannot be loaded (e.g. offline with no cached copy)
+    try:
+        get_embedding_tokenizer()
+        token_counter = count_tokens
+    except Exception:
+        token_counter = _estimate_tokens_batch
+
+    header = ", ".join(embed_columns)
+    header_tokens = token_counter([header])[0]
+
+    lines: list[str] = []
+    meta_rows: list[list[str]] = []
+    block_start, num_tokens = 0, header_tokens
+
+    def make_block(row_end: int) -> Document:
+        metadata = {"source": path, "row_start": block_start, "row_end": row_end}
+        if metadata_columns:
+            # chunk metadata must be scalar; keep the extra columns as a json object of lists
+            metadata["columns"] = json.dumps(
+                dict(zip(metadata_columns, map(list, zip(*meta_rows))))
+            )
+
+        return Document(page_content="\n".join([header, *lines]), metadata=metadata)
+
+    row = 0
+    for frame in pd.read_csv(
+        path, chunksize=read_chunk_rows, dtype=str, keep_default_na=False
+    ):
+        frame_lines = frame[embed_columns].agg(", ".join, axis=1).tolist()
+        frame_meta = frame[metadata_columns].values.tolist()
+
+        for line, meta, line_tokens in zip(
+            frame_lines, frame_meta, token_counter(frame_lines)
+        ):
+            if lines and num_tokens + line_tokens > block_tokens:
+                yield make_block(row_end=row - 1)
+                lines, meta_rows = [], []
+                block_start, num_tokens = row, header_tokens
+
+            lines.append(line)
+            meta_rows.append(meta)
+            num_tokens += line_tokens
+            row += 1
+
+    if lines:
+        yield make_block(row_end=row - 1)
+
+
 def split_docs(
     docs: list[Document],
     chunk_size: int = DocSplitterDefaultArgs.CHUNK_SIZE,
     chunk_overlap: int = DocSplitterDefaultArgs.CHUNK_OVERLAP,
+    unit: SplitterUnit = SplitterUnit.CHARACTER,
 ) -> list[Document]:
+    if unit == SplitterUnit.TOKEN:
+        return split_docs_by_token(
+            docs=docs, chunk_size=chunk_size, chunk_overlap=chunk_overlap
+        )
+
+    # the character splitter accepts an overlap equal to the chunk size; reject it like the
+    # token splitter does
+    if chunk_overlap >= chunk_size:
+        raise ValueError(
+            f"chunk overlap ({chunk_overlap}) must be smaller than chunk size ({chunk_size})"
+        )
+
     splitter = RecursiveCharacterTextSplitter(
         chunk_size=chunk_size, chunk_overlap=chunk_overlap
     )
@@ -66,17 +202,305 @@ def split_docs(
     return chunks
 
 
-def create_retrieval(
-    client: chromadb.ClientAPI,
-    collection_name: str,
-) -> VectorStoreRetriever:
-    db = Chroma(
-        client=client,
-        collection_name=collection_name,
-        embedding_function=OllamaEmbeddings(model=OLLAMA_EMBEDDING_NAME),
+def split_docs_by_token(
+    docs: list[Document],
+    chunk_size: int,
+    chunk_overlap: int,
+) -> list[Document]:
+    # all documents are tokenized in a single batched call, which the rust tokenizer spreads
+    # across cores; chunks are then cut from the original text using the token offsets so
+    # every chunk is at most chunk_size tokens of the embedding model
+    if chunk_overlap >= chunk_size:
+        raise ValueError(
+            f"chunk overlap ({chunk_overlap}) must be smaller than chunk size ({chunk_size})"
+        )
+
+    encodings = get_embedding_tokenizer().encode_batch(
+        [doc.page_content for doc in docs], add_special_tokens=False
     )
+    step = chunk_size - chunk_overlap
+
+    chunks = []
+    for doc, enc in zip(docs, encodings):
+        offsets = enc.offsets
+
+        for start in range(0, len(offsets), step):
+            window = offsets[start : start + chunk_size]
+            chunks.append(
+                Document(
+                    page_content=doc.page_content[window[0][0] : window[-1][1]],
+                    metadata=dict(doc.metadata),
+                )
+            )
+
+            if start + chunk_size >= len(offsets):
+                break
+
+    return chunks
+
+
+def split_docs_into_parents(
+    docs: list[Document],
+    parent_chunk_size: int = ParentSplitterDefaultArgs.CHUNK_SIZE,
+    chunk_size: int = DocSplitterDefaultArgs.CHUNK_SIZE,
+    chunk_overlap: int = DocSplitterDefaultArgs.CHUNK_OVERLAP,
+    unit: SplitterUnit = SplitterUnit.CHARACTER,
+) -> tuple[list[Document], list[Document]]:
+    # small-to-big: large parent spans (in tokens) are kept out of the vector store, and only
+    # the small child chunks cut from them are embedded; children point back via parent_id
+    parents = split_docs_by_token(
+        docs=docs, chunk_size=parent_chunk_size, chunk_overlap=0
+    )
+    for parent in parents:
+        parent.metadata["parent_id"] = str(uuid.uuid4())
+
+    children = split_docs(
+        docs=parents, chunk_size=chunk_size, chunk_overlap=chunk_overlap, unit=unit
+    )
+
+    return parents, children
+
+
+class ParentExpandingRetriever(BaseRetriever):
+    """Replaces child chunk hits by their parent spans, deduplicated, under a token budget.
+
+    Hits without a parent (chunks ingested the ordinary way) are passed through as they are,
+    counted with a length estimate so no tokenizer is needed at query time.
+    """
+
+    retriever: BaseRetriever
+    registry: DocumentRegistry
+    max_tokens: int = ParentSplitterDefaultArgs.CONTEXT_MAX_TOKENS
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        return self.expand(
+            self.retriever.invoke(query, config={"callbacks": run_manager.get_child()})
+        )
+
+    def expand(self, hits: list[Document]) -> list[Document]:
+        parents = self.registry.get_parents(
+            list(
+                {
+                    hit.metadata["parent_id"]
+                    for hit in hits
+                    if "parent_id" in hit.metadata
+                }
+            )
+        )
+
+        expanded, seen, budget = [], set(), self.max_tokens
+        for hit in hits:
+            parent_id = hit.metadata.get("parent_id")
+            if parent_id in seen:
+                continue
+
+            if parent_id in parents:
+                doc, num_tokens = parents[parent_id]
+            else:
+                doc, num_tokens = hit, estimate_tokens(hit.page_content)
+
+            # a parent that does not fit falls back to the (smaller) child that matched; its
+            # other matching children may still fit, so the parent is not marked as seen
+            if num_tokens > budget and doc is not hit:
+                doc, num_tokens = hit, estimate_tokens(hit.page_content)
+
+            if num_tokens > budget:
+                continue
 
-    return db.as_retriever()
+            expanded.append(doc)
+            budget -= num_tokens
+            if doc is not hit:
+                seen.add(parent_id)
+
+        return expanded
+
+
+# shared by all sessions; a collection that misses its deadline keeps running here in the
+# background without holding up the answer
+_federated_executor = ThreadPoolExecutor(
+    max_workers=FEDERATED_MAX_WORKERS, thread_name_prefix="federated-retrieval"
+)
+
+
+def _search_by_vector(
+    store: VectorStore, vector: list[float], k: int, filter: dict[str, Any] | None
+) -> list[tuple[Document, float]]:
+    # similarity_search_with_relevance_scores for a query that is already embedded; the
+    # by-vector search returns raw scores (distances for chroma)
+    relevance = store._select_relevance_score_fn()
+
+    return [
+        (doc, relevance(score))
+        for doc, score in store.similarity_search_by_vector_with_relevance_scores(
+            vector, k=k, filter=filter
+        )
+    ]
+
+
+class FederatedRetriever(BaseRetriever):
+    """Queries several collections concurrently and merges their hits into one top-k.
+
+    The query is embedded once; each collection gets its own reduction of that vector.
+    """
+
+    vectorstores: dict[str, VectorStore]
+    embedding: Embeddings
+    filters: dict[str, dict[str, Any]] = {}
+    k: int = RETRIEVAL_TOP_K
+    timeout: float = FEDERATED_RETRIEVAL_TIMEOUT
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        vector = self.embedding.embed_query(query)
+
+        futures = {
+            _federated_executor.submit(
+                _search_by_vector,
+                store,
+                store.embeddings.reduce([vector])[0]
+                if isinstance(store.embeddings, ReducedEmbeddings)
+                else vector,
+                k=self.k,
+                filter=self.filters.get(name),
+            ): name
+            for name, store in self.vectorstores.items()
+        }
+        done, not_done = wait(futures, timeout=self.timeout)
+        for future in not_done:
+            future.cancel()
+
+        scored = []
+        for future in done:
+            if future.exception() is not None:
+                continue
+
+            # relevance scores are already mapped to [0, 1] by each store's score function,
+            # so hits from different collections can be ranked against each other directly
+            for doc, score in future.result():
+                doc.metadata["collection"] = futures[future]
+                scored.append((doc, score))
+
+        scored.sort(key=lambda hit: hit[1], reverse=True)
+
+        return [doc for doc, _ in scored[: self.k]]
+
+
+# separate from the federated pool: a speculative retrieval may itself fan out to that pool,
+# and sharing one pool could deadlock when it is saturated
+_speculative_executor = ThreadPoolExecutor(thread_name_prefix="speculative-retrieval")
+
+
+def _query_similarity(query: str, other: str) -> float:
+    # jaccard similarity of the word sets; cheap and good enough to tell a verbatim
+    # pass-through from a real rewrite
+    words, other_words = (set(re.findall(r"\w+", q.lower())) for q in (query, other))
+    if not words and not other_words:
+        return 1.0
+
+    return len(words & other_words) / len(words | other_words)
+
+
+def _merge_docs(*doc_lists: list[Document], k: int) -> list[Document]:
+    # interleave by rank, dropping chunks already seen
+    merged, seen = [], set()
+    for docs in zip_longest(*doc_lists):
+        for doc in docs:
+            if doc is not None and doc.page_content not in seen:
+                seen.add(doc.page_content)
+                merged.append(doc)
+
+    return merged[:k]
+
+
+def create_speculative_retriever(
+    llm: ChatOllama,
+    retriever: BaseRetriever,
+    prompt: ChatPromptTemplate,
+) -> Runnable:
+    """Like create_history_aware_retriever, but retrieval on the raw user query starts
+    while the llm is still rewriting it, instead of after.
+
+    The speculative hits are reused when the rewrite barely changes the query, merged with
+    a second retrieval when it changes it moderately, and discarded otherwise.
+    """
+    rewrite_chain = prompt | llm | StrOutputParser()
+
+    # speculate and merge on the child hits; parent spans are expanded once, after the merge,
+    # so the merged context stays within the expander's token budget
+    if isinstance(retriever, ParentExpandingRetriever):
+        search, expand = retriever.retriever.invoke, retriever.expand
+    else:
+        search, expand = retriever.invoke, lambda docs: docs
+
+    def retrieve(inputs: dict[str, Any]) -> list[Document]:
+        query = inputs["input"]
+        if not inputs.get("chat_history"):
+            return retriever.invoke(query)
+
+        speculative: Future = _speculative_executor.submit(search, query)
+        rewritten = rewrite_chain.invoke(inputs)
+
+        similarity = _query_similarity(query, rewritten)
+        if similarity >= SPECULATIVE_REUSE_THRESHOLD:
+            return expand(speculative.result())
+
+        if similarity >= SPECULATIVE_MERGE_THRESHOLD:
+            return expand(
+                _merge_docs(search(rewritten), speculative.result(), k=RETRIEVAL_TOP_K)
+            )
+
+        # cancel() only helps if the speculative search is still queued; one that is already
+        # running finishes in the background and its hits are simply not used
+        speculative.cancel()
+        return expand(search(rewritten))
+
+    return RunnableLambda(retrieve).with_config(run_name="speculative_retriever")
+
+
+def create_retrieval(
+    backend: VectorBackend,
+    registry: DocumentRegistry,
+    collection_names: list[str],
+    document_tags: dict[str, list[str]] | None = None,
+) -> BaseRetriever:
+    # collections with selected documents are searched only within those documents
+    filters = {
+        name: {"tag": {"$in": tags}}
+        for name, tags in (document_tags or {}).items()
+        if tags
+    }
+    vectorstores = {
+        name: backend.vectorstore(
+            name=name,
+            embedding=embeddings_for_collection(
+                base=get_query_embeddings(), metadata=backend.get_metadata(name=name)
+            ),
+        )
+        for name in collection_names
+    }
+
+    if len(vectorstores) == 1:
+        ((name, db),) = vectorstores.items()
+        search_kwargs = {"k": RETRIEVAL_TOP_K}
+        if name in filters:
+            search_kwargs["filter"] = filters[name]
+
+        retriever = db.as_retriever(search_kwargs=search_kwargs)
+    else:
+        retriever = FederatedRetriever(
+            vectorstores=vectorstores,
+            embedding=get_query_embeddings(),
+            filters=filters,
+        )
+
+    # only collections ingested with parent retrieval need expanding
+    if not registry.has_parents(collection_names):
+        return retriever
+
+    return ParentExpandingRetriever(retriever=retriever, registry=registry)
 
 
 def validate_splitter_args(arg: Any):
@@ -85,12 +509,20 @@ def validate_splitter_args(arg: Any):
 
 def create_chain(
     ollama_model_name: str,
-    retriever: VectorStoreRetriever,
+    retriever: BaseRetriever,
     temperature: float,
+    speculative_retrieval: bool = False,
+    prompt_layout: PromptLayout = PromptLayout.DEFAULT,
 ) -> Runnable:
     # TODO: add more params like temperature, etc; this will also in the ui
 
-    llm = ChatOllama(model=ollama_model_name, temperature=temperature)
+    llm = ChatOllama(
+        model=ollama_model_name,
+        temperature=temperature,
+        num_ctx=OLLAMA_NUM_CTX,
+        keep_alive=OLLAMA_KEEP_ALIVE,
+        callbacks=[PromptEvalLogger()],
+    )
 
     contextualize_q_system_prompt = (
         "Given a chat history and the latest user question "
@@ -106,9 +538,14 @@ def create_chain(
             ("human", "{input}"),
         ]
     )
-    history_aware_retriever = create_history_aware_retriever(
-        llm, retriever, contextualize_q_prompt
-    )
+    if speculative_retrieval:
+        history_aware_retriever = create_speculative_retriever(
+            llm, retriever, contextualize_q_prompt
+        )
+    else:
+        history_aware_retriever = create_history_aware_retriever(
+            llm, retriever, contextualize_q_prompt
+        )
 
     qa_system_prompt = (
         "You are an assistant for question-answering tasks. Use "
@@ -116,16 +553,25 @@ def create_chain(
         "question. If you don't know the answer, just say that you "
         "don't know. Avoid a very long answer and keep the answer "
         "concise."
-        "\n\n"
-        "{context}"
-    )
-    qa_prompt = ChatPromptTemplate.from_messages(
-        [
-            ("system", qa_system_prompt),
-            MessagesPlaceholder(variable_name="chat_history"),
-            ("human", "{input}"),
-        ]
     )
+    if prompt_layout == PromptLayout.PREFIX_STABLE:
+        # the system message and history are a prefix that only grows turn by turn, so
+        # ollama can reuse its kv cache for them; the per-turn context goes last
+        qa_prompt = ChatPromptTemplate.from_messages(
+            [
+                ("system", qa_system_prompt),
+                MessagesPlaceholder(variable_name="chat_history"),
+                ("human", "Context:\n{context}\n\nQuestion: {input}"),
+            ]
+        )
+    else:
+        qa_prompt = ChatPromptTemplate.from_messages(
+            [
+                ("system", qa_system_prompt + "\n\n{context}"),
+                MessagesPlaceholder(variable_name="chat_history"),
+                ("human", "{input}"),
+            ]
+        )
 
     question_answer_chain = create_stuff_documents_chain(llm=llm, prompt=qa_prompt)
     rag_chain = create_retrieval_chain(history_aware_retriever, question_answer_chain)
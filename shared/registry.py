@@ -0,0 +1,240 @@
+import json
+import sqlite3
+import zlib
+from contextlib import closing
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any
+
+from langchain_core.documents import Document
+
+from shared.defns import DOCUMENT_REGISTRY_PATH
+
+
+@dataclass(frozen=True)
+class DocumentDescription:
+    tag: str
+    collection: str
+    source: str | None
+    hash: str | None
+    size: int | None
+    num_chunks: int
+    date_created: str
+
+
+class DocumentRegistry:
+    """Which chunks in the vector store came from which uploaded document.
+
+    Deleting a document then only touches that document's chunk ids, and the document list
+    of a collection can be shown without scanning the vector store.
+    """
+
+    def __init__(self, path: str = DOCUMENT_REGISTRY_PATH):
+        self.path = path
+
+        with closing(self._connect()) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS documents ("
+                "collection TEXT NOT NULL, "
+                "tag TEXT NOT NULL, "
+                "source TEXT, "
+                "hash TEXT, "
+                "size INTEGER, "
+                "num_chunks INTEGER NOT NULL DEFAULT 0, "
+                "date_created TEXT NOT NULL, "
+                "PRIMARY KEY (collection, tag))"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS documents_hash ON documents (collection, hash)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS chunks ("
+                "collection TEXT NOT NULL, "
+                "tag TEXT NOT NULL, "
+                "chunk_id TEXT NOT NULL, "
+                "PRIMARY KEY (collection, chunk_id), "
+                "FOREIGN KEY (collection, tag) REFERENCES documents (collection, tag) "
+                "ON DELETE CASCADE ON UPDATE CASCADE)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS chunks_tag ON chunks (collection, tag)"
+            )
+            # parent spans for small-to-big retrieval; text is zlib-compressed since parents
+            # are only read back a few at a time
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS parents ("
+                "parent_id TEXT NOT NULL, "
+                "collection TEXT NOT NULL, "
+                "tag TEXT NOT NULL, "
+                "text BLOB NOT NULL, "
+                "metadata TEXT NOT NULL, "
+                "num_tokens INTEGER NOT NULL, "
+                "PRIMARY KEY (collection, parent_id), "
+                "FOREIGN KEY (collection, tag) REFERENCES documents (collection, tag) "
+                "ON DELETE CASCADE ON UPDATE CASCADE)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS parents_id ON parents (parent_id)")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS parents_tag ON parents (collection, tag)"
+            )
+
+    def add_document(
+        self,
+        collection: str,
+        tag: str,
+        source: str | None = None,
+        hash: str | None = None,
+        size: int | None = None,
+        date_created: str | None = None,
+    ) -> None:
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO documents "
+                "(tag, collection, source, hash, size, date_created) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    tag,
+                    collection,
+                    source,
+                    hash,
+                    size,
+                    date_created or datetime.now().strftime("%Y-%m-%d-%H-%M-%S"),
+                ),
+            )
+
+    def add_chunks(self, collection: str, tag: str, chunk_ids: list[str]) -> None:
+        with closing(self._connect()) as conn, conn:
+            conn.executemany(
+                "INSERT INTO chunks (collection, tag, chunk_id) VALUES (?, ?, ?)",
+                [(collection, tag, chunk_id) for chunk_id in chunk_ids],
+            )
+            conn.execute(
+                "UPDATE documents SET num_chunks = num_chunks + ? "
+                "WHERE collection = ? AND tag = ?",
+                (len(chunk_ids), collection, tag),
+            )
+
+    def add_parents(
+        self,
+        collection: str,
+        tag: str,
+        parents: list[Document],
+        num_tokens: list[int],
+    ) -> None:
+        with closing(self._connect()) as conn, conn:
+            conn.executemany(
+                "INSERT INTO parents "
+                "(parent_id, collection, tag, text, metadata, num_tokens) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        parent.metadata["parent_id"],
+                        collection,
+                        tag,
+                        zlib.compress(parent.page_content.encode()),
+                        json.dumps(parent.metadata),
+                        n,
+                    )
+                    for parent, n in zip(parents, num_tokens)
+                ],
+            )
+
+    def get_parents(self, parent_ids: list[str]) -> dict[str, tuple[Document, int]]:
+        # parent ids are uuids, unique across collections (an imported copy holds the same text)
+        if not parent_ids:
+            return {}
+
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT parent_id, text, metadata, num_tokens FROM parents "
+                f"WHERE parent_id IN ({','.join('?' * len(parent_ids))})",
+                parent_ids,
+            ).fetchall()
+
+        return {
+            parent_id: (
+                Document(
+                    page_content=zlib.decompress(text).decode(),
+                    metadata=json.loads(metadata),
+                ),
+                num_tokens,
+            )
+            for parent_id, text, metadata, num_tokens in rows
+        }
+
+    def list_parents(self, collection: str) -> list[dict[str, Any]]:
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT tag, text, metadata, num_tokens FROM parents WHERE collection = ?",
+                (collection,),
+            ).fetchall()
+
+        return [
+            {
+                "tag": tag,
+                "text": zlib.decompress(text).decode(),
+                "metadata": json.loads(metadata),
+                "num_tokens": num_tokens,
+            }
+            for tag, text, metadata, num_tokens in rows
+        ]
+
+    def has_parents(self, collections: list[str]) -> bool:
+        if not collections:
+            return False
+
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                "SELECT 1 FROM parents "
+                f"WHERE collection IN ({','.join('?' * len(collections))}) LIMIT 1",
+                collections,
+            ).fetchone()
+
+        return row is not None
+
+    def list_documents(self, collection: str) -> list[DocumentDescription]:
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT tag, collection, source, hash, size, num_chunks, date_created "
+                "FROM documents WHERE collection = ? ORDER BY date_created",
+                (collection,),
+            ).fetchall()
+
+        return [DocumentDescription(*row) for row in rows]
+
+    def find_by_hash(self, collection: str, hash: str) -> str | None:
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                "SELECT tag FROM documents WHERE collection = ? AND hash = ?",
+                (collection, hash),
+            ).fetchone()
+
+        return row[0] if row else None
+
+    def chunk_ids(self, collection: str, tag: str) -> list[str]:
+        with closing(self._connect()) as conn:
+            return [
+                row[0]
+                for row in conn.execute(
+                    "SELECT chunk_id FROM chunks WHERE collection = ? AND tag = ?",
+                    (collection, tag),
+                )
+            ]
+
+    def remove_document(self, collection: str, tag: str) -> None:
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "DELETE FROM documents WHERE collection = ? AND tag = ?",
+                (collection, tag),
+            )
+
+    def remove_collection(self, collection: str) -> None:
+        with closing(self._connect()) as conn, conn:
+            conn.execute("DELETE FROM documents WHERE collection = ?", (collection,))
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path)
+        conn.execute("PRAGMA foreign_keys = ON")
+
+        return conn
@@ -0,0 +1,205 @@
+import sqlite3
+import uuid
+from contextlib import closing
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any
+
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
+
+from shared.defns import SESSION_DB_PATH
+from shared.utils import estimate_tokens
+
+# a session is only read or written by the client that owns it
+_OWNED = "id = ? AND client_id = ?"
+
+
+@dataclass(frozen=True)
+class StoredMessage:
+    id: int
+    role: str
+    content: str
+    num_tokens: int
+
+
+@dataclass(frozen=True)
+class SessionDescription:
+    id: str
+    title: str
+    last_active: str
+
+
+class SessionStore:
+    """Chat sessions persisted in sqlite so they survive reconnects.
+
+    Messages are appended one at a time with their (estimated) token count computed once on
+    write, so a token-bounded history window is a single indexed query instead of a recount.
+    Every session belongs to the client (browser) that started it and is only visible to it.
+    """
+
+    def __init__(self, path: str = SESSION_DB_PATH):
+        self.path = path
+
+        with closing(self._connect()) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "id TEXT PRIMARY KEY, "
+                "app TEXT NOT NULL, "
+                "client_id TEXT NOT NULL DEFAULT '', "
+                "title TEXT NOT NULL, "
+                "date_created TEXT NOT NULL, "
+                "last_active TEXT NOT NULL, "
+                "history_start_id INTEGER NOT NULL DEFAULT 0)"
+            )
+            # session stores created before the stable prompt layout lack the anchor column
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(sessions)")]
+            if "history_start_id" not in columns:
+                conn.execute(
+                    "ALTER TABLE sessions "
+                    "ADD COLUMN history_start_id INTEGER NOT NULL DEFAULT 0"
+                )
+            # sessions stored before they were scoped to a client belong to nobody
+            if "client_id" not in columns:
+                conn.execute(
+                    "ALTER TABLE sessions ADD COLUMN client_id TEXT NOT NULL DEFAULT ''"
+                )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS sessions_client "
+                "ON sessions (app, client_id, last_active)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS messages ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "session_id TEXT NOT NULL REFERENCES sessions(id) ON DELETE CASCADE, "
+                "role TEXT NOT NULL, "
+                "content TEXT NOT NULL, "
+                "num_tokens INTEGER NOT NULL)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS messages_session ON messages (session_id, id)"
+            )
+
+    def create_session(self, app: str, client_id: str, title: str) -> str:
+        session_id = str(uuid.uuid4())
+        now = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
+
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT INTO sessions "
+                "(id, app, client_id, title, date_created, last_active) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (session_id, app, client_id, title, now, now),
+            )
+
+        return session_id
+
+    def list_sessions(
+        self, app: str, client_id: str, limit: int
+    ) -> list[SessionDescription]:
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT id, title, last_active FROM sessions "
+                "WHERE app = ? AND client_id = ? "
+                "ORDER BY last_active DESC LIMIT ?",
+                (app, client_id, limit),
+            ).fetchall()
+
+        return [SessionDescription(*row) for row in rows]
+
+    def append_message(
+        self, session_id: str, client_id: str, role: str, content: str
+    ) -> None:
+        num_tokens = estimate_tokens(content)
+
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT INTO messages (session_id, role, content, num_tokens) "
+                f"SELECT id, ?, ?, ? FROM sessions WHERE {_OWNED}",
+                (role, content, num_tokens, session_id, client_id),
+            )
+            conn.execute(
+                f"UPDATE sessions SET last_active = ? WHERE {_OWNED}",
+                (datetime.now().strftime("%Y-%m-%d-%H-%M-%S"), session_id, client_id),
+            )
+
+    def load_recent(
+        self, session_id: str, client_id: str, limit: int
+    ) -> list[StoredMessage]:
+        return self._select(
+            "SELECT * FROM ("
+            "SELECT id, role, content, num_tokens FROM messages "
+            f"WHERE session_id = (SELECT id FROM sessions WHERE {_OWNED}) "
+            "ORDER BY id DESC LIMIT ?) ORDER BY id",
+            (session_id, client_id, limit),
+        )
+
+    def load_window(
+        self, session_id: str, client_id: str, max_tokens: int
+    ) -> list[StoredMessage]:
+        # newest messages whose cumulative token count fits the budget, oldest first; the
+        # newest message is always kept even if it alone is over budget
+        return self._select(
+            "SELECT id, role, content, num_tokens FROM ("
+            "SELECT *, SUM(num_tokens) OVER (ORDER BY id DESC) AS running FROM messages "
+            f"WHERE session_id = (SELECT id FROM sessions WHERE {_OWNED})) "
+            "WHERE running <= ? OR running = num_tokens ORDER BY id",
+            (session_id, client_id, max_tokens),
+        )
+
+    def load_stable_window(
+        self, session_id: str, client_id: str, max_tokens: int
+    ) -> list[StoredMessage]:
+        # every message from the session's anchor on, so between turns the history only grows
+        # at the end and the prompt prefix ollama has cached stays valid; once over budget
+        # the anchor jumps forward to about half the budget, so the prefix is rebuilt every
+        # few turns instead of shifting by one message every turn
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                f"SELECT history_start_id FROM sessions WHERE {_OWNED}",
+                (session_id, client_id),
+            ).fetchone()
+        if row is None:
+            return []
+
+        messages = self._select(
+            "SELECT id, role, content, num_tokens FROM messages "
+            "WHERE session_id = ? AND id >= ? ORDER BY id",
+            (session_id, row[0]),
+        )
+        if sum(m.num_tokens for m in messages) <= max_tokens:
+            return messages
+
+        messages = self.load_window(session_id, client_id, max_tokens // 2)
+        # start on a user turn where possible so the history reads as whole exchanges
+        start = next((i for i, m in enumerate(messages) if m.role == "user"), 0)
+        messages = messages[start:]
+
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "UPDATE sessions SET history_start_id = ? WHERE id = ?",
+                (messages[0].id, session_id),
+            )
+
+        return messages
+
+    def _select(self, query: str, params: tuple[Any, ...]) -> list[StoredMessage]:
+        with closing(self._connect()) as conn:
+            return [StoredMessage(*row) for row in conn.execute(query, params)]
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path)
+        conn.execute("PRAGMA foreign_keys = ON")
+
+        return conn
+
+
+def to_ollama_messages(messages: list[StoredMessage]) -> list[dict[str, str]]:
+    return [{"role": m.role, "content": m.content} for m in messages]
+
+
+def to_langchain_messages(messages: list[StoredMessage]) -> list[BaseMessage]:
+    return [
+        HumanMessage(m.content) if m.role == "user" else AIMessage(m.content)
+        for m in messages
+    ]
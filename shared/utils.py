@@ -1,11 +1,19 @@
+import hashlib
+import io
+import json
+import logging
+import math
 import uuid
+import zipfile
 from dataclasses import asdict, dataclass
 from datetime import datetime
-from typing import Any, Iterator
+from functools import lru_cache
+from itertools import batched
+from typing import Any, AsyncIterator, Callable, Iterable, Iterator
 
-import chromadb
+import numpy as np
 import ollama
-from langchain_chroma import Chroma
+from langchain_core.callbacks import BaseCallbackHandler
 from langchain_core.documents import Document
 from langchain_core.messages import (
     AIMessage,
@@ -13,9 +21,28 @@ from langchain_core.messages import (
     HumanMessage,
     trim_messages,
 )
+from langchain_core.outputs import LLMResult
 from langchain_ollama import OllamaEmbeddings
+from tokenizers import Tokenizer
+
+from shared.backends import Records, VectorBackend, get_default_backend
+from shared.defns import (
+    CHARS_PER_TOKEN,
+    EMBEDDING_BATCH_SIZE,
+    EMBEDDING_DIM,
+    EMBEDDING_TOKENIZER_NAME,
+    OLLAMA_EMBEDDING_NAME,
+    RECORD_BATCH_SIZE,
+    SNAPSHOT_FORMAT_VERSION,
+    ChangeKind,
+    EmbeddingPrecision,
+    Error,
+)
+from shared.embeddings import embeddings_for_collection, reduce_vectors
+from shared.events import ChangeEvent, ChangeLog
+from shared.registry import DocumentDescription, DocumentRegistry
 
-from shared.defns import CHROMA_DB_PERSISTENT_DIR, OLLAMA_EMBEDDING_NAME, Error
+logger = logging.getLogger(__name__)
 
 
 @dataclass(frozen=True)
@@ -25,6 +52,8 @@ class CollectionDescription:
     date_created: str | None = None
     tag: str | None = None
     num_chunks: int | None = None
+    embedding_dim: int | None = None
+    embedding_precision: str | None = None
 
 
 @dataclass(frozen=True)
@@ -32,43 +61,50 @@ class CollectionMetadata:
     description: str | None
     date_created: str | None = None
     tag: str | None = None
+    embedding_dim: int = EMBEDDING_DIM
+    embedding_precision: str = EmbeddingPrecision.FLOAT32
 
 
 # TODO: add delete/update docs
 class CollectionClient:
-    def __init__(self):
-        self.client = chromadb.PersistentClient(path=CHROMA_DB_PERSISTENT_DIR)
+    def __init__(self, backend: VectorBackend | None = None):
+        self.backend = backend if backend is not None else get_default_backend()
+        self.registry = DocumentRegistry()
+        self.changes = ChangeLog()
+        self._last_change = self.changes.last_id()
 
     def list_collections(self) -> list[str]:
-        return self.client.list_collections()
-
-    def get_collection(self, name: str) -> tuple[chromadb.Collection, Error]:
-        try:
-            collection = self.client.get_collection(name=name)
-        except Exception as err:
-            return None, repr(err)
-
-        return collection, None
+        return self.backend.list_collections()
 
     def create_collection(
         self,
         name: str,
         description: str = None,
+        embedding_dim: int = EMBEDDING_DIM,
+        embedding_precision: EmbeddingPrecision = EmbeddingPrecision.FLOAT32,
     ) -> Error:
+        if (
+            embedding_precision != EmbeddingPrecision.FLOAT32
+            and not self.backend.supports_reduced_precision
+        ):
+            return f"{type(self.backend).__name__} always stores float32 embeddings; lower precision needs the faiss backend"
+
         metadata = asdict(
             CollectionMetadata(
                 description=description,
                 date_created=datetime.now().strftime("%Y-%m-%d-%H-%M-%S"),
                 tag=f"collection-{str(uuid.uuid4())}-{datetime.now().strftime('%Y-%m-%d-%H-%M-%S')}",
+                embedding_dim=embedding_dim,
+                embedding_precision=embedding_precision,
             )
         )
 
         try:
-            _ = self.client.create_collection(
-                name=name,
-                metadata=metadata,
-                get_or_create=False,
-            )
+            self.backend.create_collection(name=name, metadata=metadata)
+            # a collection of the same name may have been deleted without its registry rows
+            # (e.g. by another tool); start the new one with a clean registry
+            self.registry.remove_collection(collection=name)
+            self.changes.publish(kind=ChangeKind.COLLECTION_CREATED, collection=name)
         except Exception as err:
             return repr(err)
 
@@ -76,7 +112,9 @@ class CollectionClient:
 
     def delete_collection(self, name: str) -> Error:
         try:
-            _ = self.client.delete_collection(name=name)
+            self.backend.delete_collection(name=name)
+            self.registry.remove_collection(collection=name)
+            self.changes.publish(kind=ChangeKind.COLLECTION_DELETED, collection=name)
 
         except Exception as err:
             return repr(err)
@@ -86,72 +124,369 @@ class CollectionClient:
     def add_documents(
         self,
         collection_name: str,
-        documents: list[str | Document],
+        documents: Iterable[str | Document],
         description: str | None,
+        source: str | None = None,
+        file_hash: str | None = None,
+        size: int | None = None,
+        parents: list[Document] | None = None,
     ) -> Error:
+        if (
+            file_hash is not None
+            and self.registry.find_by_hash(collection=collection_name, hash=file_hash)
+            is not None
+        ):
+            return f"{source or 'This document'} has already been added to {collection_name} collection"
+
         # since our documents will be a list of chunks obtained from a text splitter; it is
         # necessary to have a single tag for all the documents in the list.
-        uuids = [str(uuid.uuid4()) for _ in range(len(documents))]
-        metadata = asdict(
-            CollectionMetadata(
-                description=description,
-                date_created=datetime.now().strftime("%Y-%m-%d-%H-%M-%S"),
-                tag=f"document-{str(uuid.uuid4())}-{datetime.now().strftime('%Y-%m-%d-%H-%M-%S')}",
-            )
-        )  # here, this metadata is tagged to the whole docs
-
-        # chroma object from langchain is used here because documents is of type lanchain Document;
-        # it will also integrate with retriever well
-        db = Chroma(
-            client=self.client,
-            collection_name=collection_name,
-            embedding_function=OllamaEmbeddings(model=OLLAMA_EMBEDDING_NAME),
+        tag = f"document-{str(uuid.uuid4())}-{datetime.now().strftime('%Y-%m-%d-%H-%M-%S')}"
+        metadata = {
+            "tag": tag,
+            "date_created": datetime.now().strftime("%Y-%m-%d-%H-%M-%S"),
+        }  # here, this metadata is tagged to every chunk of the docs
+        if description:
+            metadata["description"] = description
+        if source:
+            metadata["source"] = source
+
+        self.registry.add_document(
+            collection=collection_name,
+            tag=tag,
+            source=source,
+            hash=file_hash,
+            size=size,
         )
 
         try:
-            _ = db.add_documents(
-                documents=documents,
-                ids=uuids,
-                metadata=metadata,
+            if parents:
+                # parent spans live in the registry, not the vector store; documents are their
+                # child chunks, which carry a parent_id
+                self.registry.add_parents(
+                    collection=collection_name,
+                    tag=tag,
+                    parents=parents,
+                    num_tokens=count_tokens([p.page_content for p in parents]),
+                )
+
+            db = self.backend.vectorstore(
+                name=collection_name,
+                embedding=embeddings_for_collection(
+                    base=OllamaEmbeddings(model=OLLAMA_EMBEDDING_NAME),
+                    metadata=self.backend.get_metadata(name=collection_name),
+                ),
+            )
+            # documents may be a lazy stream (e.g. csv blocks); embed and write it batch by batch
+            for batch in batched(documents, EMBEDDING_BATCH_SIZE):
+                batch = [
+                    Document(page_content=doc) if isinstance(doc, str) else doc
+                    for doc in batch
+                ]
+                for doc in batch:
+                    doc.metadata.update(metadata)
+
+                ids = [str(uuid.uuid4()) for _ in batch]
+                _ = db.add_documents(documents=batch, ids=ids)
+                self.registry.add_chunks(
+                    collection=collection_name, tag=tag, chunk_ids=ids
+                )
+
+            self.changes.publish(
+                kind=ChangeKind.DOCUMENTS_ADDED, collection=collection_name
             )
+
         except Exception as err:
+            # roll back the chunks written before the failure so the upload can be retried
+            _ = self.delete_documents(collection_name=collection_name, tag=tag)
             return f"Error in adding documents to {collection_name} collection. More info: {err}"
 
         return None
 
     def delete_documents(self, collection_name: str, tag: str) -> Error:
-        collection, err = self.get_collection(name=collection_name)
-        if err is not None:
-            return f"Error fetching collection with name {collection_name}. More info: {err}"
-
         try:
-            _ = collection.delete(where={"tag": tag})
+            chunk_ids = self.registry.chunk_ids(collection=collection_name, tag=tag)
+            if chunk_ids:
+                for ids in batched(chunk_ids, RECORD_BATCH_SIZE):
+                    self.backend.delete_ids(name=collection_name, ids=list(ids))
+            else:
+                # documents added before the registry existed can only be found by metadata
+                self.backend.delete(name=collection_name, where={"tag": tag})
+
+            self.registry.remove_document(collection=collection_name, tag=tag)
+            self.changes.publish(
+                kind=ChangeKind.DOCUMENTS_DELETED, collection=collection_name
+            )
 
         except Exception as err:
             return repr(err)
 
         return None
 
+    def list_documents(self, collection_name: str) -> list[DocumentDescription]:
+        return self.registry.list_documents(collection=collection_name)
+
     def describe_collection(
         self, collection_name: str
     ) -> tuple[CollectionDescription, Error]:
-        collection, err = self.get_collection(name=collection_name)
-        if err is not None:
+        try:
+            metadata = self.backend.get_metadata(name=collection_name)
+            num_chunks = self.backend.count(name=collection_name)
+        except Exception as err:
             return (
                 CollectionDescription(),
-                f"Error fetching collection with name {collection_name}. More info: {err}",
+                f"Error fetching collection with name {collection_name}. More info: {err!r}",
             )
 
-        metadata = collection.metadata
-
         return CollectionDescription(
-            name=collection.name,
+            name=collection_name,
             description=metadata["description"],
             date_created=metadata["date_created"],
             tag=metadata["tag"],
-            num_chunks=collection.count(),
+            num_chunks=num_chunks,
+            embedding_dim=metadata.get("embedding_dim", EMBEDDING_DIM),
+            embedding_precision=metadata.get(
+                "embedding_precision", EmbeddingPrecision.FLOAT32
+            ),
         ), None
 
+    def reindex_collection(
+        self,
+        name: str,
+        embedding_dim: int,
+        embedding_precision: EmbeddingPrecision,
+    ) -> Error:
+        if (
+            embedding_precision != EmbeddingPrecision.FLOAT32
+            and not self.backend.supports_reduced_precision
+        ):
+            return f"{type(self.backend).__name__} always stores float32 embeddings; lower precision needs the faiss backend"
+
+        try:
+            metadata = self.backend.get_metadata(name=name)
+        except Exception as err:
+            return f"Error fetching collection with name {name}. More info: {err!r}"
+
+        # narrowing dims or precision is computed from the stored vectors; widening needs the
+        # information that was thrown away, so those chunks are re-embedded from their text
+        precisions = list(EmbeddingPrecision)
+        reembed = embedding_dim > metadata.get(
+            "embedding_dim", EMBEDDING_DIM
+        ) or precisions.index(embedding_precision) < precisions.index(
+            metadata.get("embedding_precision", EmbeddingPrecision.FLOAT32)
+        )
+        embeddings = OllamaEmbeddings(model=OLLAMA_EMBEDDING_NAME)
+
+        # build the re-indexed copy next to the original and swap it in only once complete
+        tmp_name = f"{name}-reindex-{uuid.uuid4().hex[:8]}"
+        try:
+            self.backend.create_collection(
+                name=tmp_name,
+                metadata={
+                    **metadata,
+                    "embedding_dim": embedding_dim,
+                    "embedding_precision": embedding_precision,
+                },
+            )
+
+            for records in self.backend.iter_records(
+                name=name, batch_size=RECORD_BATCH_SIZE
+            ):
+                vectors = (
+                    embeddings.embed_documents(records.texts)
+                    if reembed
+                    else records.vectors
+                )
+                records.vectors = reduce_vectors(vectors, dim=embedding_dim)
+                self.backend.add_records(name=tmp_name, records=records)
+
+        except Exception as err:
+            _ = self.delete_collection(tmp_name)
+            return f"Error re-indexing {name} collection. More info: {err!r}"
+
+        try:
+            self.backend.delete_collection(name=name)
+            self.backend.rename_collection(name=tmp_name, new_name=name)
+            self.changes.publish(kind=ChangeKind.COLLECTION_REINDEXED, collection=name)
+        except Exception as err:
+            return f"Error swapping in re-indexed collection {tmp_name} for {name}. More info: {err!r}"
+
+        return None
+
+    def export_collection(self, name: str, path: str) -> Error:
+        """Write the collection, vectors included, to a zip bundle at path.
+
+        The bundle holds a manifest plus one part per record batch; each part stores its
+        vectors as a .npy array and ids, texts and metadatas as json columns.
+        """
+        try:
+            metadata = self.backend.get_metadata(name=name)
+            # int8 and float16 vectors lose nothing when written as float16
+            dtype = (
+                np.float32
+                if metadata.get("embedding_precision", EmbeddingPrecision.FLOAT32)
+                == EmbeddingPrecision.FLOAT32
+                else np.float16
+            )
+
+            with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as bundle:
+                num_parts, count = 0, 0
+                for records in self.backend.iter_records(
+                    name=name, batch_size=RECORD_BATCH_SIZE
+                ):
+                    part = f"part-{num_parts:05d}"
+                    buffer = io.BytesIO()
+                    np.save(buffer, records.vectors.astype(dtype))
+                    # vectors barely compress; skip deflate for them
+                    bundle.writestr(
+                        f"{part}/vectors.npy",
+                        buffer.getvalue(),
+                        compress_type=zipfile.ZIP_STORED,
+                    )
+                    for column in ("ids", "texts", "metadatas"):
+                        bundle.writestr(
+                            f"{part}/{column}.json",
+                            json.dumps(getattr(records, column)),
+                        )
+
+                    num_parts += 1
+                    count += len(records.ids)
+
+                bundle.writestr(
+                    "parents.json", json.dumps(self.registry.list_parents(name))
+                )
+                # hash and size keep duplicate-upload detection working after a restore
+                bundle.writestr(
+                    "documents.json",
+                    json.dumps(
+                        [
+                            {
+                                "tag": doc.tag,
+                                "source": doc.source,
+                                "hash": doc.hash,
+                                "size": doc.size,
+                                "date_created": doc.date_created,
+                            }
+                            for doc in self.registry.list_documents(name)
+                        ]
+                    ),
+                )
+                bundle.writestr(
+                    "manifest.json",
+                    json.dumps(
+                        {
+                            "format_version": SNAPSHOT_FORMAT_VERSION,
+                            "name": name,
+                            "metadata": metadata,
+                            "num_parts": num_parts,
+                            "count": count,
+                        }
+                    ),
+                )
+
+        except Exception as err:
+            return f"Error exporting {name} collection. More info: {err!r}"
+
+        return None
+
+    def import_collection(self, path: str, name: str | None = None) -> Error:
+        """Create a collection from a bundle written by export_collection.
+
+        Vectors are loaded as stored; the embedding model is never called.
+        """
+        try:
+            with zipfile.ZipFile(path) as bundle:
+                manifest = json.loads(bundle.read("manifest.json"))
+                if manifest["format_version"] != SNAPSHOT_FORMAT_VERSION:
+                    return f"Unsupported snapshot format version {manifest['format_version']}"
+
+                name = name or manifest["name"]
+                self.backend.create_collection(name=name, metadata=manifest["metadata"])
+                self.registry.remove_collection(collection=name)
+
+                try:
+                    # registered before the chunks, which would otherwise create bare entries
+                    if "documents.json" in bundle.namelist():
+                        for doc in json.loads(bundle.read("documents.json")):
+                            self.registry.add_document(collection=name, **doc)
+
+                    for i in range(manifest["num_parts"]):
+                        part = f"part-{i:05d}"
+                        columns = {
+                            column: json.loads(bundle.read(f"{part}/{column}.json"))
+                            for column in ("ids", "texts", "metadatas")
+                        }
+                        vectors = np.load(
+                            io.BytesIO(bundle.read(f"{part}/vectors.npy"))
+                        )
+                        records = Records(vectors=vectors.astype(np.float32), **columns)
+                        self.backend.add_records(name=name, records=records)
+                        self._register_records(collection=name, records=records)
+
+                    if "parents.json" in bundle.namelist():
+                        self._register_parents(
+                            collection=name,
+                            parents=json.loads(bundle.read("parents.json")),
+                        )
+
+                except Exception:
+                    # do not leave a half-imported collection behind
+                    _ = self.delete_collection(name)
+                    raise
+
+            self.changes.publish(kind=ChangeKind.COLLECTION_CREATED, collection=name)
+
+        except Exception as err:
+            return f"Error importing collection from {path}. More info: {err!r}"
+
+        return None
+
+    def sync(self) -> list[ChangeEvent]:
+        """Pick up changes made by any session in any worker since the last sync.
+
+        Stale in-process caches of the touched collections are dropped; the events are
+        returned so the caller can refresh its views.
+        """
+        events = self.changes.since(self._last_change)
+        if events:
+            self._last_change = events[-1].id
+
+        for collection in {event.collection for event in events}:
+            self.backend.invalidate(name=collection)
+
+        return events
+
+    def _register_records(self, collection: str, records: Records) -> None:
+        # rebuild registry entries from the per-chunk tag and source metadata
+        by_tag: dict[str, list[tuple[str, dict[str, Any]]]] = {}
+        for id_, meta in zip(records.ids, records.metadatas):
+            if "tag" in meta:
+                by_tag.setdefault(meta["tag"], []).append((id_, meta))
+
+        for tag, chunks in by_tag.items():
+            self.registry.add_document(
+                collection=collection, tag=tag, source=chunks[0][1].get("source")
+            )
+            self.registry.add_chunks(
+                collection=collection, tag=tag, chunk_ids=[id_ for id_, _ in chunks]
+            )
+
+    def _register_parents(self, collection: str, parents: list[dict[str, Any]]) -> None:
+        by_tag: dict[str, list[dict[str, Any]]] = {}
+        for parent in parents:
+            by_tag.setdefault(parent["tag"], []).append(parent)
+
+        for tag, rows in by_tag.items():
+            self.registry.add_document(collection=collection, tag=tag)
+            self.registry.add_parents(
+                collection=collection,
+                tag=tag,
+                parents=[
+                    Document(page_content=row["text"], metadata=row["metadata"])
+                    for row in rows
+                ],
+                num_tokens=[row["num_tokens"] for row in rows],
+            )
+
 
 def stream_response(response: Iterator[ollama.ChatResponse | Any], rag: bool = False):
     for chunk in response:
@@ -161,9 +496,80 @@ def stream_response(response: Iterator[ollama.ChatResponse | Any], rag: bool = F
                 yield chunk["answer"]
 
         else:
+            if chunk.done:
+                log_prompt_eval(
+                    chunk.model, chunk.prompt_eval_count, chunk.prompt_eval_duration
+                )
             yield chunk.message.content
 
 
+def log_prompt_eval(
+    model: str | None, prompt_eval_count: int | None, prompt_eval_duration: int | None
+) -> None:
+    # prompt_eval_count only counts the prompt tokens ollama had to evaluate, so with a
+    # stable prefix it drops to roughly the new turn once the kv cache is reused
+    logger.info(
+        "model=%s prompt_eval_count=%s prompt_eval_ms=%.1f",
+        model,
+        prompt_eval_count,
+        (prompt_eval_duration or 0) / 1e6,
+    )
+
+
+class PromptEvalLogger(BaseCallbackHandler):
+    """Logs ollama's prompt evaluation stats at the end of every chat model call."""
+
+    def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
+        for generations in response.generations:
+            for generation in generations:
+                info = generation.generation_info or {}
+                if "prompt_eval_count" in info:
+                    log_prompt_eval(
+                        info.get("model"),
+                        info.get("prompt_eval_count"),
+                        info.get("prompt_eval_duration"),
+                    )
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+async def astream_response(response: AsyncIterator[Any]) -> AsyncIterator[str]:
+    # stream_response(rag=True) for a chain run with astream
+    async for chunk in response:
+        if "answer" in chunk:
+            yield chunk["answer"]
+
+
+def record_stream(
+    chunks: Iterator[str], on_complete: Callable[[str], None]
+) -> Iterator[str]:
+    # pass a response stream through unchanged and hand the full text over once it ends
+    parts = []
+    for chunk in chunks:
+        parts.append(chunk)
+        yield chunk
+
+    on_complete("".join(parts))
+
+
+async def arecord_stream(
+    chunks: AsyncIterator[str], on_complete: Callable[[str], None]
+) -> AsyncIterator[str]:
+    parts = []
+    async for chunk in chunks:
+        parts.append(chunk)
+        yield chunk
+
+    on_complete("".join(parts))
+
+
 def format_chat_history(
     human_msg_content: str, ai_msg_content: str
 ) -> list[BaseMessage]:
@@ -184,3 +590,23 @@ def trim_chat_history(
     )
 
     return selected_messages
+
+
+@lru_cache(maxsize=1)
+def get_embedding_tokenizer() -> Tokenizer:
+    # loaded once per process; the rust tokenizer is thread-safe and batches in parallel
+    tokenizer = Tokenizer.from_pretrained(EMBEDDING_TOKENIZER_NAME)
+    tokenizer.no_truncation()
+    tokenizer.no_padding()
+
+    return tokenizer
+
+
+def estimate_tokens(text: str) -> int:
+    return max(1, math.ceil(len(text) / CHARS_PER_TOKEN))
+
+
+def count_tokens(texts: list[str]) -> list[int]:
+    encodings = get_embedding_tokenizer().encode_batch(texts, add_special_tokens=False)
+
+    return [len(enc.ids) for enc in encodings]
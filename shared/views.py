@@ -2,10 +2,17 @@ import faicons as fa
 from shiny import ui
 
 from shared.defns import (
+    CLIENT_ID_STORAGE_KEY,
     DEFAULT_LLM_TEMPERATURE,
+    EMBEDDING_DIM,
+    MATRYOSHKA_DIMS,
+    CsvBlockDefaultArgs,
     DocSplitterDefaultArgs,
+    EmbeddingPrecision,
     FileType,
     Model,
+    ParentSplitterDefaultArgs,
+    SplitterUnit,
 )
 
 
@@ -50,7 +57,32 @@ def create_del_collection_modal(collection_name: str) -> ui.Tag:
     )
 
 
-def create_collection_modal() -> ui.Tag:
+def create_del_document_modal(
+    collection_name: str, document_names: list[str]
+) -> ui.Tag:
+    return ui.modal(
+        ui.markdown("\n".join(f"- {name}" for name in document_names)),
+        title=f"Are you sure you want to delete these documents from {collection_name} collection?",
+        easy_close=True,
+        footer=ui.input_action_button(
+            "delete_document",
+            "Yes, delete documents",
+            class_="btn btn-primary",
+        ),
+        size="m",
+        fade=True,
+    )
+
+
+def create_collection_modal(reduced_precision: bool) -> ui.Tag:
+    # lower precision only shrinks a backend that stores quantized codes (faiss)
+    precision_select = ui.input_select(
+        id="collection_embedding_precision",
+        label="Stored embedding precision",
+        choices=[p for p in EmbeddingPrecision],
+        selected=EmbeddingPrecision.FLOAT32,
+    )
+
     return ui.modal(
         ui.input_text(
             id="collection_name",
@@ -64,6 +96,23 @@ def create_collection_modal() -> ui.Tag:
             placeholder="Describe your collection",
             width="500px",
         ),
+        ui.row(
+            ui.column(
+                6,
+                ui.input_select(
+                    id="collection_embedding_dim",
+                    label="Stored embedding dimensions",
+                    choices=[str(d) for d in MATRYOSHKA_DIMS],
+                    selected=str(EMBEDDING_DIM),
+                ),
+            ),
+            ui.column(6, precision_select) if reduced_precision else None,
+        ),
+        ui.help_text(
+            "Fewer dimensions or lower precision give a smaller, faster index at some loss of recall."
+            if reduced_precision
+            else "Fewer dimensions give a smaller, faster index at some loss of recall."
+        ),
         title="Create a collection to hold your documents",
         easy_close=True,
         footer=ui.input_action_button(
@@ -79,14 +128,19 @@ def create_collection_modal() -> ui.Tag:
 def create_desc_value_box(desc_text_ui: ui.Tag) -> ui.Tag:
     action_buttons = [
         ui.column(
-            4,
+            3,
             ui.input_action_button(
                 id=f"goto_{id}",
                 label=id.replace("_", " ").capitalize(),
                 class_="btn btn-primary",
             ),
         )
-        for id in ("add_document", "delete_collection", "create_collection")
+        for id in (
+            "add_document",
+            "delete_document",
+            "delete_collection",
+            "create_collection",
+        )
     ]
 
     return ui.card(
@@ -112,6 +166,19 @@ def create_doc_add_modal(collection_name: str):
     )
 
     options_ui = ui.row(
+        ui.column(
+            12,
+            ui.input_radio_buttons(
+                id="splitter_unit",
+                label="Measure chunks in",
+                choices={
+                    SplitterUnit.CHARACTER: "Characters",
+                    SplitterUnit.TOKEN: "Embedding tokens",
+                },
+                selected=SplitterUnit.CHARACTER,
+                inline=True,
+            ),
+        ),
         ui.column(
             6,
             ui.input_numeric(
@@ -132,6 +199,53 @@ def create_doc_add_modal(collection_name: str):
         ),
     )
 
+    csv_options_ui = ui.div(
+        ui.input_checkbox(
+            id="csv_as_blocks",
+            label="Ingest CSV files as blocks of rows (much faster for large tables)",
+            value=False,
+        ),
+        ui.panel_conditional(
+            "input.csv_as_blocks",
+            ui.row(
+                ui.column(
+                    6,
+                    ui.input_numeric(
+                        id="csv_block_tokens",
+                        label="Tokens per block",
+                        value=CsvBlockDefaultArgs.BLOCK_TOKENS,
+                        min=1,
+                    ),
+                ),
+                ui.column(
+                    6,
+                    ui.input_text(
+                        id="csv_embed_columns",
+                        label="Columns to embed (comma separated, empty for all)",
+                        placeholder="e.g. title, summary",
+                    ),
+                ),
+            ),
+        ),
+    )
+
+    parent_options_ui = ui.div(
+        ui.input_checkbox(
+            id="parent_retrieval",
+            label="Small-to-big retrieval: match on the chunks above, answer with larger parent spans",
+            value=False,
+        ),
+        ui.panel_conditional(
+            "input.parent_retrieval",
+            ui.input_numeric(
+                id="parent_chunk_size",
+                label="Parent span size (tokens)",
+                value=ParentSplitterDefaultArgs.CHUNK_SIZE,
+                min=1,
+            ),
+        ),
+    )
+
     add_embed_ui = ui.input_task_button(
         id="add_document",
         label="Add and embed documents",
@@ -142,6 +256,8 @@ def create_doc_add_modal(collection_name: str):
     return ui.modal(
         upload_ui,
         options_ui,
+        parent_options_ui,
+        csv_options_ui,
         title=f"Add documents to {collection_name} collection",
         easy_close=True,
         size="m",
@@ -192,6 +308,80 @@ def create_temp_slider() -> ui.Tag:
     )
 
 
+def create_speculative_switch() -> ui.Tag:
+    return ui.input_switch(
+        id="speculative_retrieval",
+        label=(
+            "Speculative retrieval",
+            ui.br(),
+            ui.help_text(
+                "Search documents with your raw follow-up question while the model rewrites it. "
+                "Faster answers on follow-up questions."
+            ),
+        ),
+        value=False,
+    )
+
+
+def create_prompt_layout_switch() -> ui.Tag:
+    return ui.input_switch(
+        id="stable_prefix",
+        label=(
+            "Stable prompt prefix",
+            ui.br(),
+            ui.help_text(
+                "Keep earlier turns unchanged in the prompt so the model can reuse its cache. "
+                "Faster replies in long chats."
+            ),
+        ),
+        value=False,
+    )
+
+
+def create_client_id_script() -> ui.Tag:
+    # a random id kept in the browser identifies this client across reloads; it is sent as
+    # input.client_id once the app connects, and chat sessions are only listed for it
+    return ui.tags.script(
+        f"""
+        $(document).on("shiny:connected", function () {{
+            let id = window.localStorage.getItem("{CLIENT_ID_STORAGE_KEY}");
+            if (!id) {{
+                id = Array.from(
+                    window.crypto.getRandomValues(new Uint8Array(16)),
+                    (b) => b.toString(16).padStart(2, "0"),
+                ).join("");
+                window.localStorage.setItem("{CLIENT_ID_STORAGE_KEY}", id);
+            }}
+            Shiny.setInputValue("client_id", id);
+        }});
+        """
+    )
+
+
+def create_session_select(choices: dict[str, str], selected: str | None) -> ui.Tag:
+    return ui.div(
+        ui.input_select(
+            id="chat_session",
+            label=(
+                "Chat session",
+                ui.br(),
+                ui.help_text(
+                    "Chats are saved; pick one to continue where you left off."
+                ),
+            ),
+            choices={"": "New chat", **choices},
+            selected=selected or "",
+            multiple=False,
+            selectize=True,
+        ),
+        ui.input_action_button(
+            id="load_older",
+            label="Load older messages",
+            class_="btn btn-outline-secondary btn-sm",
+        ),
+    )
+
+
 def create_llm_select() -> ui.Tag:
     return ui.input_select(
         id="model",
@@ -213,13 +403,31 @@ def create_collection_select(choices: list[str]) -> ui.Tag:
     return ui.input_select(
         id="collection",
         label=(
-            "Choose or search collection",
+            "Choose or search collections",
             ui.br(),
             ui.help_text(
-                "The document collection to use for LLM context. You can always change this on the fly."
+                "The document collections to use for LLM context; they are searched together. "
+                "The first one is the collection managed below. You can always change this on the fly."
             ),
         ),
         choices=choices,
-        multiple=False,
+        selected=choices[:1],
+        multiple=True,
+        selectize=True,
+    )
+
+
+def create_document_select(choices: dict[str, str]) -> ui.Tag:
+    return ui.input_select(
+        id="documents",
+        label=(
+            "Restrict to documents",
+            ui.br(),
+            ui.help_text(
+                "Only use these documents of the first collection as context. Leave empty to use all."
+            ),
+        ),
+        choices=choices,
+        multiple=True,
         selectize=True,
     )